@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Compare context file size, store time and load time for each compression codec.
+
+Builds a per-source style context with ``--nsrc`` sources: a word frequency
+table, a source list and a number of file and scalar ContextValues, then stores
+it with ``store_context()`` and restores it with ``update_context()`` using
+no compression, gzip, bz2 and lzma.
+
+Usage::
+
+  python benchmarks/context_compression.py --nsrc 2000 --nwords 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import pyyaks.context
+import pyyaks.logger
+
+CODECS = (None, 'gzip', 'bz2', 'lzma')
+
+
+def get_opt():
+    parser = argparse.ArgumentParser(description='Context compression benchmark')
+    parser.add_argument('--nsrc', type=int, default=2000,
+                        help='Number of sources in the source list')
+    parser.add_argument('--nwords', type=int, default=5000,
+                        help='Number of entries in the word frequency table')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of loads to time (best is reported)')
+    return parser.parse_args()
+
+
+def make_context(nsrc, nwords):
+    rand = random.Random(1)
+    src = pyyaks.context.ContextDict('bench_src')
+    files = pyyaks.context.ContextDict('bench_files', basedir='data')
+    words = ['w%05d' % i for i in range(nwords)]
+    src['obsid'] = 1234
+    src['word_freq'] = dict((word, rand.randint(1, 1000)) for word in words)
+    src['sources'] = [dict(id=i, ra=rand.uniform(0, 360), dec=rand.uniform(-90, 90),
+                           name='SRC%06d' % i) for i in range(nsrc)]
+    for i in range(200):
+        src['par%d' % i] = rand.uniform(0, 1)
+        files['file%d' % i] = 'obs{{bench_src.obsid}}/file%d' % i
+    return src, files
+
+
+def main():
+    opt = get_opt()
+    pyyaks.logger.get_logger(level=pyyaks.logger.WARNING)
+    src, files = make_context(opt.nsrc, opt.nwords)
+    keys = ['bench_src', 'bench_files']
+    tmpdir = tempfile.mkdtemp()
+
+    print('{:8s} {:>10s} {:>10s} {:>10s}'.format('Codec', 'Size (MB)', 'Store (s)',
+                                                  'Load (s)'))
+    for codec in CODECS:
+        filename = os.path.join(tmpdir, 'context_{}.pkl'.format(codec))
+        t0 = time.time()
+        pyyaks.context.store_context(filename, keys=keys, compress=codec)
+        dt_store = time.time() - t0
+
+        dt_load = float('inf')
+        for _ in range(opt.repeat):
+            t0 = time.time()
+            pyyaks.context.update_context(filename, keys=keys)
+            dt_load = min(dt_load, time.time() - t0)
+
+        print('{:8s} {:10.3f} {:10.3f} {:10.3f}'.format(
+            str(codec), os.path.getsize(filename) / 1e6, dt_store, dt_load))
+        os.unlink(filename)
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
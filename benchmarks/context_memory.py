@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Measure the memory used by ContextValue objects in a large context.
+
+Loads ``--nsrc`` per-source contexts of ``--nkeys`` values each into
+unregistered ContextDicts (as done when building cross-source reports), then
+round-trips them through pickle, and reports the traced memory per value.
+
+Usage::
+
+  python benchmarks/context_memory.py --nsrc 10000 --nkeys 10
+"""
+import argparse
+import pickle
+import time
+import tracemalloc
+
+import pyyaks.context
+
+
+def get_opt():
+    parser = argparse.ArgumentParser(description='ContextValue memory benchmark')
+    parser.add_argument('--nsrc', type=int, default=10000,
+                        help='Number of per-source contexts')
+    parser.add_argument('--nkeys', type=int, default=10,
+                        help='Number of values per source')
+    return parser.parse_args()
+
+
+def make_contexts(nsrc, nkeys):
+    contexts = []
+    for isrc in range(nsrc):
+        cdict = pyyaks.context.ContextDict()
+        for ikey in range(nkeys):
+            # Small ints are cached by Python so use floats to include the values
+            cdict['key%d' % ikey] = float(isrc * nkeys + ikey)
+        contexts.append(cdict)
+    return contexts
+
+
+def main():
+    opt = get_opt()
+    nvals = opt.nsrc * opt.nkeys
+
+    tracemalloc.start()
+    t0 = time.time()
+    contexts = make_contexts(opt.nsrc, opt.nkeys)
+    dt = time.time() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('Values:               {:d}'.format(nvals))
+    print('Build time:           {:.3f} s'.format(dt))
+    print('Memory:               {:.1f} MB'.format(current / 1e6))
+    print('Bytes per value:      {:.0f}'.format(current / nvals))
+
+    t0 = time.time()
+    data = pickle.dumps(contexts, protocol=pickle.HIGHEST_PROTOCOL)
+    contexts = pickle.loads(data)
+    print('Pickle round trip:    {:.3f} s ({:.1f} MB)'.format(time.time() - t0,
+                                                          len(data) / 1e6))
+    assert contexts[-1]['key0'].val == float((opt.nsrc - 1) * opt.nkeys)
+
+
+if __name__ == '__main__':
+    main()
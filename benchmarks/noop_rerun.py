@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Time a rerun of a pipeline where every task is already up to date, with
+the usual depends and targets checks and with a build log.
+
+Each of ``--nsrc`` sources has a chain of ``--ntask`` tasks where each task
+depends on the target of the previous one.  As in the examples, each source is
+processed between its own ``start()`` and ``end()``.  The pipeline is run once
+to make the targets and then run again with and without
+``start(build_log=...)``.
+
+Usage::
+
+  python benchmarks/noop_rerun.py --nsrc 10000 --ntask 3
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import pyyaks.context
+import pyyaks.logger
+import pyyaks.task
+
+SRC = pyyaks.context.ContextDict('src')
+FILE = pyyaks.context.ContextDict('file', basedir='.')
+FILE['step0'] = 'src{{src.id}}/step0'
+FILE['step1'] = 'src{{src.id}}/step1'
+FILE['step2'] = 'src{{src.id}}/step2'
+FILE['step3'] = 'src{{src.id}}/step3'
+
+
+def touch(filename):
+    with open(filename, 'w'):
+        pass
+
+
+def make_task(istep):
+    @pyyaks.task.task()
+    @pyyaks.task.depends(depends=[FILE['step%d' % istep]],
+                         targets=[FILE['step%d' % (istep + 1)]])
+    def step():
+        touch(FILE['step%d' % (istep + 1)].abs)
+    step.__name__ = 'step%d' % (istep + 1)
+    return step
+
+
+def get_opt():
+    parser = argparse.ArgumentParser(description='No-op rerun benchmark')
+    parser.add_argument('--nsrc', type=int, default=10000,
+                        help='Number of sources')
+    parser.add_argument('--ntask', type=int, default=3, choices=(1, 2, 3),
+                        help='Number of tasks per source')
+    return parser.parse_args()
+
+
+def run(opt, tasks, build_log=None):
+    t0 = time.time()
+    for src_id in range(opt.nsrc):
+        SRC['id'] = src_id
+        pyyaks.task.start(build_log=build_log)
+        for step in tasks:
+            step()
+        pyyaks.task.end()
+    return time.time() - t0
+
+
+def main():
+    opt = get_opt()
+    pyyaks.logger.get_logger(level=pyyaks.logger.WARNING)
+    tasks = [make_task(istep) for istep in range(opt.ntask)]
+    tmpdir = tempfile.mkdtemp()
+    FILE.basedir = tmpdir
+    for src_id in range(opt.nsrc):
+        SRC['id'] = src_id
+        os.mkdir(FILE['step0'].abs.rsplit(os.sep, 1)[0])
+        touch(FILE['step0'].abs)
+    build_log = os.path.join(tmpdir, 'build.log')
+
+    print('{:25s} {:>10s}'.format('Run', 'Time (s)'))
+    print('{:25s} {:10.2f}'.format('Initial', run(opt, tasks, build_log)))
+    print('{:25s} {:10.2f}'.format('Rerun', run(opt, tasks)))
+    print('{:25s} {:10.2f}'.format('Rerun with build log', run(opt, tasks, build_log)))
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
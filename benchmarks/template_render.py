@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Compare rendering simple substitution templates directly with rendering
+them through jinja2.
+
+Each template is like ``obs{{src.obsid}}/ccd{{src.ccdid}}/acis_evt2`` and is
+rendered ``--number`` times with ``TemplateCache.render()``, which uses the
+substitution fast path, and with the compiled jinja2 template.  The render
+memo of ContextValue is bypassed so that only the template engine is timed.
+
+Usage::
+
+  python benchmarks/template_render.py --number 100000
+"""
+import argparse
+import time
+
+import pyyaks.context
+import pyyaks.logger
+
+TEMPLATES = ('obs{{src.obsid}}/ccd{{src.ccdid}}/acis_evt2',
+             '{{files.src_dir}}/{{src.name}}.fits',
+             'src{{src.id}}_{{src.obsid}}_{{src.ccdid}}_{{src.survey}}')
+
+
+def get_opt():
+    parser = argparse.ArgumentParser(description='Template render benchmark')
+    parser.add_argument('--number', type=int, default=100000,
+                        help='Number of renders of each template')
+    return parser.parse_args()
+
+
+def main():
+    opt = get_opt()
+    pyyaks.logger.get_logger(level=pyyaks.logger.WARNING)
+    src = pyyaks.context.ContextDict('src')
+    files = pyyaks.context.ContextDict('files', basedir='data')
+    src['obsid'] = 1234
+    src.format.obsid = '%05d'
+    src['ccdid'] = 7
+    src['id'] = 100
+    src['name'] = 'eta_car'
+    src['survey'] = 'DSS'
+    files['src_dir'] = 'obs{{src.obsid}}'
+
+    cache = pyyaks.context.TEMPLATE_CACHE
+    context = pyyaks.context.CONTEXT
+    print('{:55s} {:>10s} {:>10s} {:>7s}'.format('Template', 'Fast (us)', 'Jinja (us)',
+                                                  'Speedup'))
+    for template in TEMPLATES:
+        assert cache.render(template, context) == cache.get(template).render(context)
+
+        t0 = time.time()
+        for _ in range(opt.number):
+            cache.render(template, context)
+        dt_fast = (time.time() - t0) / opt.number
+
+        jinja_template = cache.get(template)
+        t0 = time.time()
+        for _ in range(opt.number):
+            jinja_template.render(context)
+        dt_jinja = (time.time() - t0) / opt.number
+
+        print('{:55s} {:10.2f} {:10.2f} {:7.1f}'.format(template, dt_fast * 1e6,
+                                                        dt_jinja * 1e6, dt_jinja / dt_fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@
 import os
 from six.moves import cPickle as pickle
 import time
-import multiprocessing
 import shutil
 
 import pyyaks.task
@@ -100,8 +99,8 @@ def set_coords():
 # Main pipeline function
 #####################################################################################
 def pipeline(src):
-    # Clear the SRC contextdict and then populate from objlist table rows
-    SRC.clear()
+    # Populate the SRC contextdict from objlist table rows.  Each source starts
+    # from a fresh SRC and task status.
     SRC['ra'], SRC['dec'], SRC['obsid'], SRC['ccdid'] = src
     SRC['xdat_id'] = '%s_%s' % (SRC.val.ra, SRC.val.dec)
 
@@ -120,5 +119,7 @@ def pipeline(src):
 # Main processing loop
 #####################################################################################
 
-pool = multiprocessing.Pool()              # start 4 worker processes
-pool.map(pipeline, srcs)
+for result in pyyaks.task.run_sources(pipeline, srcs, processes=4):
+    logger.info('Source %d %s in %.1f sec' % (result.index,
+                                              'succeeded' if result.success else 'FAILED',
+                                              result.elapsed))
@@ -133,12 +133,9 @@ def make_html(depends=(files['image.gif'],),
 #######################################################################
 # Run the pipeline for each source 
 #######################################################################
-for src in sources:
-    # 'source' is a persistent global so the data values should be cleared for each loop
-    source.clear()
-
-    # Set global source attributes ('name', 'id', 'ra_hms', etc) from inputs 'sources' values
-    source.update(zip(source_cols, src))
+for isrc in pyyaks.context.SourceCursor(source, sources, names=source_cols):
+    # Global source attributes ('name', 'id', 'ra_hms', etc) are now set from the
+    # 'sources' row and the other 'source' values are cleared.
 
     process_msg = 'Processing source id=%s name=%s' % (source['id'], source['name'])
 
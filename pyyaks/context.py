@@ -3,15 +3,32 @@ from __future__ import print_function, division, absolute_import
 
 import re
 import os
+import keyword
+import io
+import sys
 import time
+import uuid
 import stat
 import pdb
 import logging
+import threading
+import itertools
+import collections
+import functools
+import contextlib
+import contextvars
+import sqlite3
+import gzip
+import bz2
+import lzma
+import shutil
+import atexit
 
 from six.moves import cPickle as pickle
-from copy import deepcopy
 
 import jinja2
+import jinja2.meta
+from jinja2 import nodes
 import pyyaks.fileutil
 
 class NullHandler(logging.Handler):
@@ -24,6 +41,613 @@ logger.propagate = False
 
 CONTEXT = {}
 
+# Matches the start of a jinja2 variable or block tag
+TEMPLATE_TAG = re.compile(r'{[%{]')
+
+# Maximum number of times a template is re-rendered while its output still
+# contains template tags
+MAX_RENDER_PASSES = 20
+
+# Source of version numbers for ContextValue and ContextDict changes.  Numbers are
+# unique across all objects so a (object, version) pair identifies one state.
+_VERSIONS = itertools.count(1)
+
+
+class TemplateCache(object):
+    """Bounded LRU cache of compiled jinja2 templates keyed by template source.
+
+    A single module instance ``TEMPLATE_CACHE`` is shared by every ContextValue
+    so that each distinct template string is parsed and compiled only once.
+    Templates made only of ``{{ name.key }}`` or ``{{ name.key.ext }}``
+    substitutions are rendered directly by ``render()`` and never compiled.
+    Hit, miss and eviction counts are kept for profiling.
+
+    :param maxsize: maximum number of compiled templates to keep
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry(self, source, count=True):
+        with self._lock:
+            entry = self._templates.get(source)
+            if entry is not None:
+                self._templates.move_to_end(source)
+                self.hits += count
+                return entry
+            self.misses += count
+
+        # Each entry is [template, refs, parts] where each item is filled in on
+        # demand: the compiled template by get(), refs by refs() and the
+        # substitution parts by render().
+        entry = [_UNSET, _UNSET, _UNSET]
+
+        with self._lock:
+            self._templates[source] = entry
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def get(self, source):
+        """Return the compiled template for ``source``, compiling it if needed.
+
+        :param source: template source string
+        :returns: jinja2.Template
+        """
+        entry = self._entry(source)
+        if entry[0] is _UNSET:
+            self._compile(entry, source)
+        return entry[0]
+
+    def _compile(self, entry, source):
+        # Compile outside the lock; a concurrent compile of the same source is harmless.
+        stats = _STATS
+        t0 = time.perf_counter()
+        entry[0] = _ENVIRONMENT.get_template(source)
+        if stats is not None:
+            stats.add('compile', source, time.perf_counter() - t0)
+
+    def render(self, source, context):
+        """Render template ``source`` with the variables in mapping ``context``.
+
+        A template made only of ``{{ name.key }}`` or ``{{ name.key.ext }}``
+        substitutions is rendered by looking up each one the way jinja2 does
+        (attribute first, then item) and converting the result with ``str()``.
+        Anything else, or a lookup that jinja2 would treat as undefined, is
+        rendered by jinja2.
+
+        :param source: template source string
+        :param context: mapping of template variable names to values
+        :returns: rendered string
+        """
+        stats = _STATS
+        t0 = time.perf_counter()
+        entry = self._entry(source)
+        parts = entry[2]
+        if parts is _UNSET:
+            parts = entry[2] = _fast_parts(source)
+        if parts is not None:
+            strval = _fast_render(parts, context)
+            if strval is not None:
+                if stats is not None:
+                    stats.add('template_fast', source, time.perf_counter() - t0)
+                return strval
+
+        if entry[0] is _UNSET:
+            self._compile(entry, source)
+        strval = entry[0].render(context)
+        if stats is not None:
+            stats.add('template_jinja', source, time.perf_counter() - t0)
+        return strval
+
+    def refs(self, source):
+        """Return the CONTEXT references made by template ``source``.
+
+        This is a static analysis of the template (see ``template_refs()``) that
+        is cached along with the compiled template.
+
+        :param source: template source string
+        :returns: frozenset of (dict name, key) tuples or None if not analyzable
+        """
+        entry = self._entry(source, count=False)
+        if entry[1] is _UNSET:
+            parts = entry[2]
+            if parts is _UNSET:
+                parts = entry[2] = _fast_parts(source)
+            entry[1] = template_refs(source) if parts is None else _fast_refs(parts)
+        return entry[1]
+
+    def clear(self):
+        """Remove all compiled templates and reset the counters"""
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """Return a dict of cache statistics (hits, misses, evictions, size, maxsize)"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        size=len(self._templates), maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._templates)
+
+_UNSET = object()
+
+# A {{ name.key }} or {{ name.key.ext }} substitution
+_FAST_VAR = re.compile(r'{{[ \t]*([A-Za-z_][A-Za-z0-9_]*)((?:\.[A-Za-z_][A-Za-z0-9_]*){1,2})[ \t]*}}')
+
+# Names that jinja2 treats specially or that cannot start an expression
+_FAST_RESERVED = frozenset(keyword.kwlist) | frozenset(('true', 'false', 'none', 'self',
+                                                        'loop', 'caller', 'varargs',
+                                                        'kwargs'))
+
+def _fast_parts(source):
+    """Split template ``source`` into alternating literal strings and (name,
+    attrs) substitutions, or return None if it is not made only of simple
+    substitutions that render the same without jinja2."""
+    env = _ENVIRONMENT
+    if (type(env) is not jinja2.Environment or env.extensions or env.finalize is not None
+            or env.autoescape is not False or env.line_statement_prefix is not None
+            or env.line_comment_prefix is not None
+            or (env.variable_start_string, env.variable_end_string, env.block_start_string,
+                env.comment_start_string) != ('{{', '}}', '{%', '{#')):
+        return None
+    # jinja2 removes a trailing newline and normalizes newlines
+    if '\n' in source or '\r' in source:
+        return None
+
+    parts = []
+    pos = 0
+    for match in _FAST_VAR.finditer(source):
+        name = match.group(1)
+        if name in _FAST_RESERVED:
+            return None
+        parts.append(source[pos:match.start()])
+        parts.append((name, tuple(match.group(2)[1:].split('.'))))
+        pos = match.end()
+    parts.append(source[pos:])
+
+    for literal in parts[::2]:
+        if '{{' in literal or '{%' in literal or '{#' in literal:
+            return None
+    return tuple(parts)
+
+# ContextDict attributes like src.val that give access to its values by key
+_ACCESSORS = ('val', 'rel', 'abs', 'format')
+
+def _ref_key(keys):
+    """Return the ContextDict key referenced by the chain of attribute or item
+    ``keys``, which for an accessor like ``src.val.x`` is the key after it"""
+    if keys[0] in _ACCESSORS and len(keys) > 1:
+        return keys[1]
+    return keys[0]
+
+def _fast_refs(parts):
+    """Return the template refs (see ``template_refs()``) of fast ``parts``"""
+    refs = set()
+    for name, attrs in parts[1::2]:
+        if name in _ENVIRONMENT.globals:
+            continue
+        if 'mtime' in attrs[1:]:
+            return None
+        refs.add((name, _ref_key(attrs)))
+    return frozenset(refs)
+
+def _fast_render(parts, context):
+    """Render fast template ``parts`` with ``context``, or return None if a
+    lookup would be undefined in jinja2"""
+    out = []
+    for idx, part in enumerate(parts):
+        if idx % 2 == 0:
+            out.append(part)
+            continue
+        name, attrs = part
+        obj = context.get(name, _UNSET)
+        if obj is _UNSET:
+            return None
+        for attr in attrs:
+            # Same as jinja2.Environment.getattr()
+            try:
+                obj = getattr(obj, attr)
+            except AttributeError:
+                try:
+                    obj = obj[attr]
+                except (TypeError, LookupError, AttributeError):
+                    return None
+        out.append(str(obj))
+    return ''.join(out)
+
+# ContextValues being rendered in the current thread, for catching cycles
+_rendering = threading.local()
+
+# Rendered strings of the frozen context snapshot in effect (see render_many)
+_SNAPSHOT = contextvars.ContextVar('pyyaks_snapshot', default=None)
+
+# Isolated context scope in effect (see context_scope)
+_CONTEXT_SCOPE = contextvars.ContextVar('pyyaks_context_scope', default=None)
+
+
+class ContextCycleError(ValueError):
+    """Context value templates refer to each other in a cycle"""
+    pass
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+def template_refs(source):
+    """Find the CONTEXT references made by template ``source`` with static analysis.
+
+    A reference like ``{{ src.obsid }}``, ``{{ files.evt2.fits }}`` or
+    ``{{ src['obsid'] }}`` is returned as the tuple ``(dict name, key)``, e.g.
+    ``('src', 'obsid')``.  None is returned if the template uses a context name in a
+    way that cannot be tied to specific keys (for instance iterating over a whole
+    ContextDict) or asks for a file ``mtime``, since the rendered value could then
+    change without any ContextValue being set.
+
+    :param source: template source string
+    :returns: frozenset of (dict name, key) tuples or None
+    """
+    ast = _ENVIRONMENT.parse(source)
+    names = jinja2.meta.find_undeclared_variables(ast) - set(_ENVIRONMENT.globals)
+    refs = set()
+    if not _find_refs(ast, names, refs):
+        return None
+    return frozenset(refs)
+
+def _find_refs(node, names, refs):
+    """Recursively add (name, key) references below ``node`` to ``refs``.  Returns
+    False if a reference to one of ``names`` cannot be analyzed."""
+    if isinstance(node, (nodes.Getattr, nodes.Getitem)):
+        # Unwind a chain like src.evt2.fits down to the base Name node
+        chain = []
+        base = node
+        while isinstance(base, (nodes.Getattr, nodes.Getitem)):
+            chain.append(base)
+            base = base.node
+        if isinstance(base, nodes.Name) and base.name in names:
+            chain.reverse()
+            keys = []
+            for link in chain:
+                if isinstance(link, nodes.Getattr):
+                    keys.append(link.attr)
+                elif isinstance(link.arg, nodes.Const) and isinstance(link.arg.value, str):
+                    keys.append(link.arg.value)
+                else:
+                    break
+            if not keys or 'mtime' in keys[1:]:
+                return False
+            refs.add((base.name, _ref_key(keys).split('.', 1)[0]))
+            # Subscripts like src[other.key] can themselves hold references
+            for link in chain:
+                if isinstance(link, nodes.Getitem) and not _find_refs(link.arg, names, refs):
+                    return False
+            return True
+
+    if isinstance(node, nodes.Name) and node.name in names:
+        return False
+
+    for child in node.iter_child_nodes():
+        if not _find_refs(child, names, refs):
+            return False
+    return True
+
+def _value_refs(value):
+    """Return the ContextValues directly referenced by the template in ``value``"""
+    val = value._val
+    if not (isinstance(val, str) and TEMPLATE_TAG.search(val)):
+        return []
+    refs = TEMPLATE_CACHE.refs(val)
+    out = []
+    for name, key in (refs or ()):
+        cdict = _lookup(name)
+        if cdict is not None:
+            ref = dict.get(cdict, key)
+            if ref is not None:
+                out.append(ref)
+    return out
+
+def resolve_order(values):
+    """Return ``values`` and the ContextValues they refer to in dependency order.
+
+    The template reference graph across the registered ContextDicts is walked
+    from ``values`` and returned in topological order, so every value comes after
+    all the values its template refers to.  Values whose rendered template is
+    already memoized and current are not descended into.
+
+    :param values: iterable of ContextValue objects
+    :returns: list of ContextValue objects
+    :raises ContextCycleError: if the template references form a cycle
+    """
+    order = []
+    done = set()
+    for value in values:
+        if id(value) in done:
+            continue
+        # Iterative depth-first search.  ``path`` holds the values currently being
+        # visited and ``stack`` their remaining references.
+        path = [value]
+        on_path = {id(value): 0}
+        stack = [iter(_value_refs(value))]
+        while stack:
+            for ref in stack[-1]:
+                if id(ref) in done:
+                    continue
+                if id(ref) in on_path:
+                    cycle = path[on_path[id(ref)]:] + [ref]
+                    raise ContextCycleError('Context values refer to each other in a cycle: '
+                                            + ' -> '.join(x.fullname for x in cycle))
+                memo = ref._memo
+                if memo is not None and _memo_valid(memo):
+                    done.add(id(ref))
+                    order.append(ref)
+                    continue
+                on_path[id(ref)] = len(path)
+                path.append(ref)
+                stack.append(iter(_value_refs(ref)))
+                break
+            else:
+                stack.pop()
+                node = path.pop()
+                del on_path[id(node)]
+                done.add(id(node))
+                order.append(node)
+    return order
+
+def _memo_valid(memo):
+    """Check that none of the objects a render memo depends on have changed"""
+    if memo[2] is not None and memo[2] != os.getcwd():
+        return False
+    for obj, version in memo[1]:
+        if obj._version != version:
+            return False
+    return True
+
+def _render_deps(sources):
+    """Collect the dependencies of a render of template ``sources``.
+
+    The result is a tuple of (object, version) pairs covering every ContextValue
+    referenced directly or through nested templates, along with the ContextDict of
+    any file value (for the basedir).  The second return value is the current
+    directory if the rendered string contains a relative file path and None
+    otherwise.  Returns None if the render cannot be safely memoized.
+    """
+    deps = []
+    cwd = None
+    for source in sources:
+        refs = TEMPLATE_CACHE.refs(source)
+        if refs is None:
+            return None
+        for name, key in refs:
+            cdict = _lookup(name)
+            if cdict is None:
+                return None
+            value = dict.get(cdict, key)
+            if value is None:
+                # Jinja found an attribute of the ContextDict instead of a key
+                deps.append((cdict, cdict._version))
+                continue
+
+            deps.append((value, value._version))
+            basedir = value.basedir
+            if basedir:
+                # The file path depends on the current directory and, with multiple
+                # base paths, which files exist, which cannot be tracked.
+                if os.pathsep in basedir:
+                    return None
+                deps.append((value.parent, value.parent._version))
+                cwd = os.getcwd()
+
+            if isinstance(value._val, str) and TEMPLATE_TAG.search(value._val):
+                memo = value._memo
+                if memo is None or not _memo_valid(memo):
+                    return None
+                deps.extend(memo[1])
+                cwd = cwd or memo[2]
+
+    return tuple(deps), cwd
+
+
+class _SourceLoader(jinja2.BaseLoader):
+    """Jinja2 loader that treats the template name as the template source.
+
+    Loading string templates through ``Environment.get_template()`` instead of
+    ``Environment.from_string()`` lets them use the environment bytecode cache.
+    """
+    def get_source(self, environment, template):
+        return template, None, lambda: True
+
+
+_ENVIRONMENT = None
+
+def configure_environment(bytecode_cache_dir=None, **kwargs):
+    """Configure the jinja2 Environment shared by all ContextValue rendering.
+
+    If ``bytecode_cache_dir`` is supplied then compiled templates are also stored
+    there with ``jinja2.FileSystemBytecodeCache`` so that new worker processes
+    rendering the same templates can skip compilation.  The default directory
+    is taken from the ``PYYAKS_JINJA_CACHE_DIR`` environment variable when the
+    module is imported.  Configuring a new environment empties TEMPLATE_CACHE.
+
+    :param bytecode_cache_dir: directory for the on-disk bytecode cache (optional)
+    :param kwargs: additional keyword arguments for ``jinja2.Environment``
+    :returns: new jinja2.Environment
+    """
+    global _ENVIRONMENT
+
+    if bytecode_cache_dir is not None:
+        # Many worker processes may start at once
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        kwargs['bytecode_cache'] = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    kwargs.setdefault('loader', _SourceLoader())
+    # TEMPLATE_CACHE does the in-memory caching so turn off the environment cache
+    kwargs.setdefault('cache_size', 0)
+    kwargs.setdefault('auto_reload', False)
+
+    _ENVIRONMENT = jinja2.Environment(**kwargs)
+    TEMPLATE_CACHE.clear()
+    return _ENVIRONMENT
+
+def get_environment():
+    """Return the jinja2 Environment used for ContextValue rendering"""
+    return _ENVIRONMENT
+
+configure_environment(os.environ.get('PYYAKS_JINJA_CACHE_DIR'))
+
+
+class ContextStats(object):
+    """Counts, times and byte totals of context operations, in total and per
+    label.  Collection is enabled with ``collect_stats()`` or ``enable_stats()``.
+
+    The events and their labels are:
+
+    - ``compile``: jinja2 template compile (template source)
+    - ``template_fast`` / ``template_jinja``: template render pass with the
+      simple substitution renderer or jinja2 (template source)
+    - ``render``: render of a ContextValue template that was not memoized,
+      including all its passes (value full name)
+    - ``render_memo``: render answered from the memo (value full name)
+    - ``render_pass``: fixed-point render pass (value full name)
+    - ``basedir_probe``: file existence check for a multiple-path basedir
+      (value full name)
+    - ``mtime_stat``: file stat for a file value ``mtime`` (value full name)
+    - ``autogen``: key autogenerated by ``ContextDict.__getitem__`` (full name)
+    - ``store_context`` / ``update_context``: context store or update with bytes
+      written or read (file name)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, event, label=None, dt=0.0, nbytes=0):
+        """Record one ``event`` for ``label`` that took ``dt`` seconds and
+        moved ``nbytes`` bytes"""
+        with self._lock:
+            entry = self._events.get(event)
+            if entry is None:
+                entry = self._events[event] = [0, 0.0, 0]
+                self._labels[event] = {}
+            entry[0] += 1
+            entry[1] += dt
+            entry[2] += nbytes
+            if label is not None:
+                labels = self._labels[event]
+                entry = labels.get(label)
+                if entry is None:
+                    entry = labels[label] = [0, 0.0, 0]
+                entry[0] += 1
+                entry[1] += dt
+                entry[2] += nbytes
+
+    def reset(self):
+        """Set all counts, times and byte totals to zero"""
+        with self._lock:
+            self._events = {}
+            self._labels = {}
+
+    def snapshot(self):
+        """Return a copy of the statistics as a dict keyed by event.  Each value
+        is a dict with ``count``, ``time`` (seconds), ``bytes`` and ``labels``,
+        where ``labels`` holds the same count, time and bytes per label."""
+        def as_dict(entry):
+            return dict(count=entry[0], time=entry[1], bytes=entry[2])
+
+        with self._lock:
+            out = {}
+            for event, entry in self._events.items():
+                out[event] = as_dict(entry)
+                out[event]['labels'] = dict((label, as_dict(x))
+                                            for label, x in self._labels[event].items())
+            return out
+
+    def top(self, event, n=10, sort='time'):
+        """Return the ``n`` labels with the largest ``sort`` value (``'time'``,
+        ``'count'`` or ``'bytes'``) for ``event``.
+
+        :returns: list of (label, count, time, bytes) tuples
+        """
+        idx = ('count', 'time', 'bytes').index(sort)
+        with self._lock:
+            labels = [(label,) + tuple(entry)
+                      for label, entry in self._labels.get(event, {}).items()]
+        return sorted(labels, key=lambda x: x[idx + 1], reverse=True)[:n]
+
+_STATS = None
+
+def enable_stats(enable=True):
+    """Start (or with ``enable=False`` stop) collecting statistics of context
+    operations for the whole process.
+
+    :param enable: collect statistics
+    :returns: ContextStats object being collected into (None if disabled)
+    """
+    global _STATS
+    _STATS = (_STATS or ContextStats()) if enable else None
+    return _STATS
+
+def get_stats():
+    """Return the ContextStats object being collected into, or None"""
+    return _STATS
+
+@contextlib.contextmanager
+def collect_stats():
+    """Context manager that collects statistics of context operations in the
+    block into a new ContextStats object::
+
+      with pyyaks.context.collect_stats() as stats:
+          run_pipeline()
+      print(stats.top('render'))
+
+    The previous statistics collection (if any) resumes after the block.
+    """
+    global _STATS
+    prev_stats = _STATS
+    _STATS = ContextStats()
+    try:
+        yield _STATS
+    finally:
+        _STATS = prev_stats
+
+
+_STAT_CACHE = None
+
+def set_stat_cache(cache):
+    """Set the cache used for file existence checks when resolving the base
+    paths of file ContextValues and for file ``mtime`` values.  Typically this
+    is set once at the start of a pipeline run::
+
+      pyyaks.context.set_stat_cache(pyyaks.fileutil.StatCache(ttl=600))
+
+    Tasks run through ``pyyaks.task`` invalidate the cache after they run.
+
+    :param cache: pyyaks.fileutil.StatCache object or None to disable caching
+    :returns: previous stat cache
+    """
+    global _STAT_CACHE
+    prev_cache = _STAT_CACHE
+    _STAT_CACHE = cache
+    return prev_cache
+
+def get_stat_cache():
+    """Return the stat cache set with ``set_stat_cache()`` (or None)"""
+    return _STAT_CACHE
+
+def invalidate_stat_cache(path=None):
+    """Forget cached file status for absolute ``path``, or for all files if ``path``
+    is None.  This must be called after writing files that file ContextValues
+    may refer to.  It does nothing if no stat cache is set.
+
+    :param path: absolute file path (default=None => all files)
+    """
+    if _STAT_CACHE is not None:
+        _STAT_CACHE.invalidate(path)
+
+
 def render(val):
     """Render ``val`` using the template engine and the current context.
 
@@ -36,6 +660,37 @@ def render(val):
     else:
         return str(ContextValue(val))
 
+@contextlib.contextmanager
+def _frozen_context():
+    """Context manager that treats CONTEXT as a frozen snapshot.
+
+    Within the block each ContextValue (or plain template string) is rendered at
+    most once and the result is reused for every later lookup, including lookups
+    made from inside other templates.  The context must not be changed within
+    the block.
+    """
+    if _SNAPSHOT.get() is not None:
+        yield
+        return
+
+    token = _SNAPSHOT.set({})
+    try:
+        yield
+    finally:
+        _SNAPSHOT.reset(token)
+
+def render_many(vals):
+    """Render each of ``vals`` against a single frozen snapshot of the current context.
+
+    This gives the same results as ``[render(x) for x in vals]`` but each
+    referenced ContextValue is rendered only once for the whole batch.
+
+    :param vals: iterable of input values
+    :returns: list of rendered values
+    """
+    with _frozen_context():
+        return [render(val) for val in vals]
+
 def render_args(*argids):
     """
     Decorate a function so that the specified arguments are rendered via
@@ -75,38 +730,807 @@ def render_args(*argids):
         return newfunc
     return decorate
 
+
+class _ContextScope(object):
+    """Isolated view of the registered ContextDicts (see ``context_scope()``).
+
+    Each ContextDict used within the scope is forked on first use into a private
+    copy and all access to it is delegated to that copy.  ``forks`` maps
+    id(ContextDict) to (ContextDict, fork), where a fork maps to itself.
+    ContextDicts with a new name made within the scope are registered in
+    ``names`` instead of CONTEXT.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.forks = {}
+        self.names = {}
+        self.locals = {}
+        self.context = collections.ChainMap(self.names,
+                                            CONTEXT if parent is None else parent.context)
+
+    def add(self, cdict):
+        """Add ``cdict`` made within this scope, which needs no fork"""
+        self.forks[id(cdict)] = (cdict, cdict)
+
+    def get(self, cdict):
+        """Return the fork of ContextDict ``cdict`` for this scope"""
+        entry = self.forks.get(id(cdict))
+        if entry is not None and entry[0] is cdict:
+            return entry[1]
+
+        origin = cdict if self.parent is None else self.parent.get(cdict)
+        fork = origin._fork()
+        self.forks[id(cdict)] = (cdict, fork)
+        self.add(fork)
+        return fork
+
+    def value(self, value):
+        """Return the ContextValue for this scope that corresponds to ``value``"""
+        cdict = self.get(value.parent)
+        if cdict is value.parent:
+            return value
+        base = cdict[value._name]
+        return base._view(value.ext) if value.ext else base
+
+
+@contextlib.contextmanager
+def context_scope():
+    """Context manager that gives the code in the block its own isolated view
+    of the registered ContextDicts.
+
+    Within the block each ContextDict (and each ContextValue taken from it,
+    including those given to task decorators) reads and changes a private
+    copy that is made from the current values on first use.  Rendering,
+    ``store_context()`` and ``update_context()`` use the same copies, and
+    ContextDicts with new names are registered only within the scope.  The
+    scope is held in a ``contextvars`` variable so it follows the code into
+    asyncio tasks created within the block.  A scope entered within another
+    scope starts from the values of the outer scope.
+
+    Use a separate scope for each pipeline run, e.g. with ``scoped()`` on the
+    function given to a thread pool.  Note that the current directory
+    (``pyyaks.task.chdir``) and environment are still shared by all threads.
+    """
+    token = _CONTEXT_SCOPE.set(_ContextScope(_CONTEXT_SCOPE.get()))
+    try:
+        yield
+    finally:
+        _CONTEXT_SCOPE.reset(token)
+
+def scoped(func):
+    """Decorate ``func`` (a function or coroutine function) so that each call
+    runs in a new ``context_scope()``.
+
+    Example::
+
+      @context.scoped
+      def pipeline(row):
+          SRC.update(row)
+          ...
+
+      with concurrent.futures.ThreadPoolExecutor(8) as pool:
+          results = list(pool.map(pipeline, rows))
+    """
+    import functools
+    import inspect
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrap_func(*args, **kwargs):
+            with context_scope():
+                return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrap_func(*args, **kwargs):
+            with context_scope():
+                return func(*args, **kwargs)
+
+    return wrap_func
+
+def scope_local(key, factory):
+    """Return an object that is private to the current ``context_scope()``.
+
+    The object for ``key`` is made by calling ``factory()`` on first use within
+    each scope.  Outside of any scope there is one global object per ``key``.
+
+    :param key: hashable key for the object
+    :param factory: callable that makes a new object
+    :returns: object
+    """
+    scope = _CONTEXT_SCOPE.get()
+    objects = _SCOPE_LOCALS if scope is None else scope.locals
+    try:
+        return objects[key]
+    except KeyError:
+        return objects.setdefault(key, factory())
+
+# Objects returned by scope_local() outside of any scope
+_SCOPE_LOCALS = {}
+
+def _context():
+    """Return the mapping of names to registered ContextDicts in effect"""
+    scope = _CONTEXT_SCOPE.get()
+    return CONTEXT if scope is None else scope.context
+
+def _lookup(name):
+    """Return the registered ContextDict ``name`` as seen by the current scope,
+    or None"""
+    cdict = _context().get(name)
+    if not isinstance(cdict, ContextDict):
+        return None
+    return cdict._scoped()
+
 def update_context(filename, keys=None):
     """Update the current context from ``filename``.  This file should be
-    created with ``store_context()``.
+    created with ``store_context()``.  Changes appended to the journal file
+    ``filename + '.journal'`` by ``store_context(..., journal=True)`` are applied
+    on top of the stored context.
+
+    For an SQLite context file (see ``store_context()``) only the values of the
+    requested ``keys`` are read.
 
     :param filename: name of file containing context
     :param keys: list of keys in CONTEXT to update (default=None => all)
     :rtype: None
     """
     logger.verbose('Restoring context from %s' % filename)
-    context = pickle.load(open(filename, 'rb'))
+    flush_context_writes()
+    stats = _STATS
+    t0 = time.perf_counter()
+    if _is_sqlite(filename):
+        nbytes = _update_context_sqlite(filename, keys)
+        if stats is not None:
+            stats.add('update_context', filename, time.perf_counter() - t0, nbytes)
+        return
+
+    with _open_context(filename) as fh:
+        context = _ContextUnpickler(fh, filename).load()
+    _replay_journal(filename, context)
+    if stats is not None:
+        nbytes = os.path.getsize(filename)
+        if os.path.exists(filename + '.journal'):
+            nbytes += os.path.getsize(filename + '.journal')
+
+    registered = _context()
     for name in context:
         if keys and name not in keys:
             continue
-        if name not in CONTEXT:
+        if name not in registered:
             raise KeyError('ContextDict %s found in %s but not in existing CONTEXT' %
                            (name, filename))
-        CONTEXT[name].update(context[name])
+        registered[name].update(context[name])
+        _seed_sidecars(filename, name, registered[name]._scoped())
+    if stats is not None:
+        stats.add('update_context', filename, time.perf_counter() - t0, nbytes)
 
-def store_context(filename, keys=None):
+def read_context_value(filename, name, key):
+    """Read the value of a single ContextValue from context file ``filename``
+    without changing the current context.  For an SQLite context file only that
+    one value is read.
+
+    :param filename: name of file containing context
+    :param name: ContextDict name
+    :param key: ContextValue key
+    :returns: value (the ``val`` attribute of the stored ContextValue)
+    """
+    if _is_sqlite(filename):
+        with contextlib.closing(sqlite3.connect(filename)) as db:
+            row = db.execute('SELECT value FROM context_values WHERE name=? AND key=?',
+                             (name, key)).fetchone()
+        if row is None:
+            raise KeyError('Context value %s.%s not found in %s' % (name, key, filename))
+        return pickle.loads(row[0])[0]
+
+    with _open_context(filename) as fh:
+        context = _ContextUnpickler(fh, filename).load()
+    _replay_journal(filename, context)
+    try:
+        return dict.__getitem__(context[name], key).val
+    except KeyError:
+        raise KeyError('Context value %s.%s not found in %s' % (name, key, filename))
+
+def store_context(filename, keys=None, journal=False, background=False, compress=None,
+                  backend=None):
     """Store the current context to ``filename``.
 
+    The file is written to a temporary file which is synced to disk and then
+    renamed to ``filename``, so an interrupted store never leaves a partial file.
+
+    With ``journal=True`` only the values that changed since the last store to
+    ``filename`` in this process are appended to the journal file
+    ``filename + '.journal'``, which ``update_context()`` replays.  The first
+    journaled store in a process, and every store with ``journal=False``, writes
+    the full context and removes the journal.
+
+    With ``background=True`` the context is pickled immediately but written by
+    a background thread.  A queued full write to the same file replaces any
+    earlier writes to it that have not started yet.  Use
+    ``flush_context_writes()`` to wait for the writes to finish.
+
+    If ``SIDECAR_THRESHOLD`` is set then a value (other than a plain string or
+    number) that is at least that many bytes is stored in its own file in the
+    directory ``filename + '.sidecar'``, using NumPy ``.npy`` format for arrays.
+    A sidecar file is only rewritten when its ContextValue is set again.  When
+    the context is restored a sidecar value is loaded on first access to
+    ``val``, with arrays memory mapped copy-on-write.  Like any other value, an
+    array changed in place is only stored again once its ContextValue is set.
+
+    The pickle is compressed with ``compress`` (``'gzip'``, ``'bz2'`` or
+    ``'lzma'``).  By default this is chosen by the extension of ``filename``:
+    ``.gz``, ``.bz2``, ``.xz`` or ``.lzma``, otherwise no compression.  A full
+    store streams the pickle through the compressor to the file, while a
+    background store compresses in the writer thread.  ``update_context()``
+    detects the compression from the file contents.  The journal is never
+    compressed.
+
+    With ``backend='sqlite'`` the context is stored in an SQLite database with
+    one row per ContextValue instead of a pickle file.  This allows
+    ``update_context()`` and ``read_context_value()`` to read selected values
+    without loading the whole context.  A journaled store then updates just the
+    changed rows.  SQLite stores are never done in the background.  By default
+    an existing ``filename`` keeps its format, and a new file is an SQLite
+    database if it ends with ``.db``, ``.sqlite`` or ``.sqlite3``.  The format
+    is detected from the file contents when reading.
+
     :param filename: name of file for storing context
     :param keys: list of keys in CONTEXT to store (default=None => all)
+    :param journal: append changed values to the journal (default=False)
+    :param background: write the file in a background thread (default=False)
+    :param compress: compression codec (default=None => from ``filename``)
+    :param backend: 'pickle' or 'sqlite' (default=None => from ``filename``)
     :rtype: None
     """
     if filename:
-        logger.verbose('Storing context to %s' % filename)
-        if keys:
-            dump_context = dict((x, CONTEXT[x]) for x in keys)
+        stats = _STATS
+        t0 = time.perf_counter()
+        nbytes = _store_context(filename, keys, journal, background, compress,
+                                _store_sqlite(filename, backend))
+        if stats is not None:
+            stats.add('store_context', filename, time.perf_counter() - t0, nbytes)
+
+def _store_context(filename, keys, journal, background, compress, sqlite=False):
+    """Store the context as for ``store_context()`` and return the number of
+    bytes written (or queued for writing)"""
+    if sqlite or not background:
+        # Keep the order with respect to queued background writes
+        flush_context_writes()
+
+    if sqlite:
+        return _store_context_sqlite(filename, keys, journal)
+
+    if journal and _journal_current(filename):
+        records = _journal_records(filename, keys)
+        if not records:
+            return 0
+        logger.verbose('Journaling %d context value(s) to %s.journal'
+                       % (len(records), filename))
+        sidecar_writes = [] if background else None
+        data = _dumps_context(filename, [x[:5] for x in records],
+                              [(x[0], x[1], x[2], x[5]) for x in records], sidecar_writes)
+        if background:
+            _submit_sidecar_writes(filename, sidecar_writes)
+            _context_writer().submit(filename, _append_journal, data)
         else:
-            dump_context = CONTEXT
-        pickle.dump(dump_context, open(filename, 'wb'))
+            _append_journal(filename, data)
+        return len(data)
+
+    logger.verbose('Storing context to %s' % filename)
+    registered = _context()
+    dump_context = dict((x, registered[x]._scoped()) for x in (keys or registered))
+    versions = _context_versions(dump_context)
+    values = [(name, key, value._val, value._version)
+              for name, cdict in dump_context.items()
+              for key, value in dict.items(cdict)]
+    if compress is None:
+        compress = _compress_codec(filename)
+    elif compress not in _CODECS:
+        raise ValueError('compress must be one of %s' % ', '.join(sorted(_CODECS)))
+
+    if background:
+        _JOURNALS[filename] = dict(base=_PENDING, versions=versions)
+        sidecar_writes = []
+        data = _dumps_context(filename, dump_context, values, sidecar_writes)
+        _submit_sidecar_writes(filename, sidecar_writes)
+        _context_writer().submit(filename, _write_context_file,
+                                 (data, compress, _used_sidecars(filename)), replace=True)
+        return len(data)
+
+    _JOURNALS[filename] = dict(base=None, versions=versions)
+    def dump(fh):
+        _dump_context(fh, filename, dump_context, values)
+    _write_context_file(filename, (dump, compress, None))
+    _clean_sidecars(filename, _used_sidecars(filename))
+    return os.path.getsize(filename)
+
+def flush_context_writes():
+    """Wait until all context writes queued by ``store_context(..., background=True)``
+    are finished.  An exception raised while writing is re-raised here.
+    """
+    if _WRITER is not None:
+        _WRITER.flush()
+
+# Minimum size in bytes of a value stored in a sidecar file (None => never)
+SIDECAR_THRESHOLD = None
+
+# Value types that are always pickled inline in the context file
+_INLINE_TYPES = (str, bytes, int, float, complex, bool, type(None))
+
+# Sidecar file used for each value stored to a context file by this process:
+# _SIDECARS[filename][name, key] = (version, file name or None)
+_SIDECARS = {}
+
+
+class _SidecarValue(object):
+    """Placeholder for a ContextValue value held in a sidecar file, which is
+    loaded on first access to the value"""
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path.endswith('.npy'):
+            import numpy as np
+            # Copy-on-write so the array can be changed without changing the file
+            return np.load(self.path, mmap_mode='c')
+        with open(self.path, 'rb') as fh:
+            return pickle.load(fh)
+
+
+class _ContextPickler(pickle.Pickler):
+    """Pickler that refers to sidecar values by file name"""
+    def __init__(self, fh, sidecar_ids):
+        super(_ContextPickler, self).__init__(fh)
+        self._sidecar_ids = sidecar_ids
+
+    def persistent_id(self, obj):
+        return self._sidecar_ids.get(id(obj))
+
+
+class _ContextUnpickler(pickle.Unpickler):
+    """Unpickler that restores sidecar values of context file ``filename``
+    as placeholders"""
+    def __init__(self, fh, filename):
+        super(_ContextUnpickler, self).__init__(fh)
+        self._sidecar_dir = os.path.abspath(filename + '.sidecar')
+
+    def persistent_load(self, pid):
+        return _SidecarValue(os.path.join(self._sidecar_dir, pid))
+
+
+def _dumps_context(filename, obj, values, sidecar_writes=None):
+    """Pickle ``obj`` for context file ``filename``.  Large values among the
+    (name, key, val, version) ``values`` go to sidecar files, which are written
+    now or appended to the ``sidecar_writes`` list to write later."""
+    buf = io.BytesIO()
+    _dump_context(buf, filename, obj, values, sidecar_writes)
+    return buf.getvalue()
+
+def _dump_context(fh, filename, obj, values, sidecar_writes=None):
+    """Pickle ``obj`` for context file ``filename`` to file object ``fh``"""
+    sidecar_ids = _store_sidecars(filename, values, sidecar_writes)
+    if sidecar_ids:
+        _ContextPickler(fh, sidecar_ids).dump(obj)
+    else:
+        pickle.dump(obj, fh)
+
+def _store_sidecars(filename, values, sidecar_writes=None):
+    """Write sidecar files as needed for (name, key, val, version) ``values``
+    and return a dict mapping id(val) to sidecar file name.  If ``sidecar_writes``
+    is a list then the (sidecar dir, sidecar, write function) of each file is
+    appended to it instead of writing the file."""
+    sidecar_dir = filename + '.sidecar'
+    if sidecar_writes is None:
+        write_sidecar = _write_sidecar
+    else:
+        def write_sidecar(*args):
+            sidecar_writes.append(args)
+    sidecars = _SIDECARS.setdefault(filename, {})
+    sidecar_ids = {}
+    for name, key, val, version in values:
+        if isinstance(val, _INLINE_TYPES):
+            sidecars.pop((name, key), None)
+            continue
+
+        prev = sidecars.get((name, key))
+        if type(val) is _SidecarValue:
+            # Value restored from a sidecar and not accessed since
+            if os.path.dirname(val.path) == os.path.abspath(sidecar_dir):
+                sidecar = os.path.basename(val.path)
+            elif prev is not None and prev[0] == version and prev[1] is not None:
+                sidecar = prev[1]
+            else:
+                # From another context file so copy it
+                sidecar = _new_sidecar_name(name, key, os.path.splitext(val.path)[1])
+                write_sidecar(sidecar_dir, sidecar, functools.partial(_copy_file, val.path))
+            sidecars[name, key] = (version, sidecar)
+            sidecar_ids[id(val)] = sidecar
+            continue
+
+        if prev is not None and prev[0] == version:
+            # Unchanged since stored or restored
+            sidecar = prev[1]
+        elif SIDECAR_THRESHOLD is None:
+            sidecars.pop((name, key), None)
+            continue
+        else:
+            sidecar = None
+            np = sys.modules.get('numpy')
+            if np is not None and isinstance(val, np.ndarray) and val.dtype != object:
+                if val.nbytes >= SIDECAR_THRESHOLD:
+                    sidecar = _new_sidecar_name(name, key, '.npy')
+                    write_sidecar(sidecar_dir, sidecar, functools.partial(np.save, arr=val))
+            else:
+                data = pickle.dumps(val)
+                if len(data) >= SIDECAR_THRESHOLD:
+                    sidecar = _new_sidecar_name(name, key, '.pkl')
+                    write_sidecar(sidecar_dir, sidecar, functools.partial(_write_data, data))
+            sidecars[name, key] = (version, sidecar)
+
+        if sidecar is not None:
+            sidecar_ids[id(val)] = sidecar
+
+    return sidecar_ids
+
+def _seed_sidecars(filename, name, cdict):
+    """Record the values of ``cdict`` restored from sidecar files of context
+    file ``filename``, so that storing them again reuses the sidecar files even
+    after the values have been loaded"""
+    sidecar_dir = os.path.abspath(filename + '.sidecar')
+    sidecars = None
+    for key, value in dict.items(cdict):
+        val = value._val
+        if type(val) is _SidecarValue and os.path.dirname(val.path) == sidecar_dir:
+            if sidecars is None:
+                sidecars = _SIDECARS.setdefault(filename, {})
+            sidecars[name, key] = (value._version, os.path.basename(val.path))
+
+def _new_sidecar_name(name, key, ext):
+    # A new name each time so existing context files keep their sidecar intact
+    return '%s.%s.%s%s' % (name, key, uuid.uuid4().hex[:12], ext)
+
+def _write_data(data, fh):
+    fh.write(data)
+
+def _copy_file(path, fh):
+    with open(path, 'rb') as src:
+        shutil.copyfileobj(src, fh)
+
+def _write_sidecar(sidecar_dir, sidecar, write):
+    if not os.path.isdir(sidecar_dir):
+        os.makedirs(sidecar_dir)
+    tmpname = os.path.join(sidecar_dir, sidecar + '.tmp')
+    with open(tmpname, 'wb') as fh:
+        write(fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmpname, os.path.join(sidecar_dir, sidecar))
+
+def _write_sidecars(filename, sidecar_writes):
+    """Write the sidecar files of ``filename`` deferred by ``_store_sidecars()``"""
+    for sidecar_dir, sidecar, write in sidecar_writes:
+        _write_sidecar(sidecar_dir, sidecar, write)
+
+def _submit_sidecar_writes(filename, sidecar_writes):
+    # Queued under the sidecar directory name so that the write is not dropped
+    # by a later full store of the context file
+    if sidecar_writes:
+        _context_writer().submit(filename + '.sidecar', _write_sidecars, sidecar_writes)
+
+def _used_sidecars(filename):
+    """Return the set of sidecar files referenced by the last store of ``filename``"""
+    return set(x[1] for x in _SIDECARS.get(filename, {}).values())
+
+def _clean_sidecars(filename, used):
+    """Remove sidecar files of ``filename`` that are not in the ``used`` set"""
+    sidecar_dir = filename + '.sidecar'
+    if not os.path.isdir(sidecar_dir):
+        return
+    for sidecar in os.listdir(sidecar_dir):
+        if sidecar not in used:
+            os.unlink(os.path.join(sidecar_dir, sidecar))
+
+# Journal state for each context file stored by this process: the identity of
+# the full context file and the version of each value when last stored.
+_JOURNALS = {}
+
+# First record of a journal file, which ties it to one full context file
+_JOURNAL_HEADER = 'pyyaks-context-journal'
+
+def _file_id(filename):
+    filestat = os.stat(filename)
+    return (filestat.st_size, filestat.st_mtime_ns)
+
+def _context_versions(context):
+    return dict(((name, key), value._version)
+                for name, cdict in context.items()
+                for key, value in dict.items(cdict))
+
+def _journal_current(filename):
+    """True if ``filename`` is still the full context file last written by
+    this process, so that changes can be journaled against it."""
+    journal = _JOURNALS.get(filename)
+    if journal is None:
+        return False
+    if journal['base'] is _PENDING:
+        return True
+    try:
+        return journal['base'] == _file_id(filename)
+    except OSError:
+        return False
+
+def _journal_records(filename, keys=None):
+    """Return (name, key, val, mtime, format, version) records for values
+    changed since the last store of ``filename``"""
+    versions = _JOURNALS[filename]['versions']
+    records = []
+    registered = _context()
+    for name in (keys or registered):
+        for key, value in dict.items(registered[name]._scoped()):
+            if versions.get((name, key)) != value._version:
+                records.append((name, key, value._val, value._mtime, value._format,
+                                value._version))
+                versions[name, key] = value._version
+    return records
+
+def _append_journal(filename, data):
+    """Append pickled journal records ``data`` to the journal of ``filename``"""
+    journal_file = filename + '.journal'
+    new_journal = not os.path.exists(journal_file)
+    with open(journal_file, 'ab') as fh:
+        if new_journal:
+            pickle.dump((_JOURNAL_HEADER, _JOURNALS[filename]['base']), fh)
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def _write_context_file(filename, data):
+    """Write context to ``filename`` via a temporary file.  ``data`` is a
+    (content, codec, used) tuple where content is the pickled bytes or a function
+    that writes them to a file object.  If ``used`` is a set of sidecar files then
+    other sidecar files of ``filename`` are removed after the write."""
+    content, codec, used = data
+    tmpname = '%s.%s.tmp' % (filename, uuid.uuid4().hex[:12])
+    # Like open() the new file gets permissions from the process umask
+    fd = os.open(tmpname, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0),
+                 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            with _compressed_file(fh, codec) as cfh:
+                if callable(content):
+                    content(cfh)
+                else:
+                    cfh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+    # The journal (if any) applied to the previous file so it is now obsolete
+    if os.path.exists(filename + '.journal'):
+        os.unlink(filename + '.journal')
+    _JOURNALS[filename]['base'] = _file_id(filename)
+
+    if used is not None:
+        _clean_sidecars(filename, used)
+
+# Compression codecs for context files: name => (magic bytes, extensions, file class)
+_CODECS = {
+    'gzip': (b'\x1f\x8b', ('.gz',), gzip.GzipFile),
+    'bz2': (b'BZh', ('.bz2',), bz2.BZ2File),
+    'lzma': (b'\xfd7zXZ\x00', ('.xz', '.lzma'), lzma.LZMAFile),
+}
+
+def _compress_codec(filename):
+    """Return the compression codec implied by the extension of ``filename``"""
+    ext = os.path.splitext(filename)[1]
+    for codec, (magic, exts, cls) in _CODECS.items():
+        if ext in exts:
+            return codec
+    return None
+
+def _compressed_file(fh, codec):
+    """Wrap binary file object ``fh`` for writing with compression ``codec``"""
+    if codec is None:
+        return contextlib.nullcontext(fh)
+    if codec == 'gzip':
+        # Leave out the file name and time so identical contexts give identical files
+        return gzip.GzipFile(filename='', mode='wb', fileobj=fh, mtime=0)
+    return _CODECS[codec][2](fh, 'wb')
+
+@contextlib.contextmanager
+def _open_context(filename):
+    """Open context file ``filename`` for reading, decompressing if needed"""
+    with open(filename, 'rb') as fh:
+        head = fh.peek(6)[:6]
+        for codec, (magic, exts, cls) in _CODECS.items():
+            if head.startswith(magic):
+                with cls(fileobj=fh, mode='rb') if codec == 'gzip' else cls(fh, 'rb') as cfh:
+                    yield cfh
+                break
+        else:
+            yield fh
+
+# Marks a full context file that is queued for writing
+_PENDING = object()
+
+
+class _ContextWriter(threading.Thread):
+    """Background thread that performs queued context file writes in order"""
+    def __init__(self):
+        super(_ContextWriter, self).__init__(name='pyyaks-context-writer')
+        self.daemon = True
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._error = None
+
+    def submit(self, filename, write, data, replace=False):
+        """Queue ``write(filename, data)``.  If ``replace`` is True then queued
+        writes to ``filename`` that have not started are dropped first."""
+        with self._cond:
+            if replace:
+                self._jobs = collections.deque(job for job in self._jobs
+                                               if job[0] != filename)
+            self._jobs.append((filename, write, data))
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                filename, write, data = self._jobs.popleft()
+                self._busy = True
+            try:
+                write(filename, data)
+            except Exception as exc:
+                logger.error('Failed writing context file %s: %s' % (filename, exc))
+                self._error = exc
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            while self._jobs or self._busy:
+                self._cond.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+_WRITER = None
+_WRITER_LOCK = threading.Lock()
+
+def _context_writer():
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = _ContextWriter()
+            _WRITER.start()
+    return _WRITER
+
+def _reset_context_writer():
+    # The writer thread does not exist in a forked child process
+    global _WRITER
+    _WRITER = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_context_writer)
+atexit.register(flush_context_writes)
+
+_SQLITE_EXTS = ('.db', '.sqlite', '.sqlite3')
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+
+def _is_sqlite(filename):
+    """True if existing context file ``filename`` is an SQLite database"""
+    try:
+        with open(filename, 'rb') as fh:
+            return fh.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+    except OSError:
+        return False
+
+def _store_sqlite(filename, backend):
+    """True if a store to ``filename`` with ``backend`` should use SQLite.  By
+    default an existing file keeps its format and a new file gets the format
+    implied by its extension."""
+    if backend is None:
+        if os.path.exists(filename):
+            return _is_sqlite(filename)
+        return os.path.splitext(filename)[1] in _SQLITE_EXTS
+    if backend not in ('pickle', 'sqlite'):
+        raise ValueError("backend must be 'pickle' or 'sqlite'")
+    return backend == 'sqlite'
+
+def _restore_value(cdict, key, val, mtime, format):
+    """Set the stored state of ContextValue ``key`` in ContextDict ``cdict``"""
+    value = cdict[key]
+    value._changing()
+    value._val, value._mtime, value._format = val, mtime, format
+    value._changed()
+
+def _store_context_sqlite(filename, keys=None, journal=False):
+    """Store the current context in SQLite database ``filename`` and return the
+    number of bytes of values written"""
+    registered = _context()
+    names = list(keys or registered)
+    prev = _JOURNALS.get(filename)
+    journal = journal and prev is not None and os.path.exists(filename)
+    versions = prev['versions'] if journal else {}
+
+    rows = []
+    for name in names:
+        for key, value in dict.items(registered[name]._scoped()):
+            if not journal or versions.get((name, key)) != value._version:
+                rows.append((name, key, pickle.dumps((value.val, value._mtime, value._format),
+                                                     protocol=pickle.HIGHEST_PROTOCOL)))
+                versions[name, key] = value._version
+
+    logger.verbose('Storing %d context value(s) to %s' % (len(rows), filename))
+    with contextlib.closing(sqlite3.connect(filename)) as db:
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS context_values '
+                       '(name TEXT, key TEXT, value BLOB, PRIMARY KEY (name, key))')
+            if not journal:
+                db.executemany('DELETE FROM context_values WHERE name=?',
+                               [(name,) for name in names])
+            db.executemany('INSERT OR REPLACE INTO context_values VALUES (?, ?, ?)', rows)
+    _JOURNALS[filename] = dict(base=None, versions=versions)
+    return sum(len(row[2]) for row in rows)
+
+def _update_context_sqlite(filename, keys=None):
+    """Update the current context from SQLite database ``filename`` and return
+    the number of bytes of values read"""
+    query = 'SELECT name, key, value FROM context_values'
+    args = ()
+    if keys:
+        query += ' WHERE name IN (%s)' % ','.join('?' * len(keys))
+        args = tuple(keys)
+
+    registered = _context()
+    nbytes = 0
+    with contextlib.closing(sqlite3.connect(filename)) as db:
+        for name, key, data in db.execute(query, args):
+            if name not in registered:
+                raise KeyError('ContextDict %s found in %s but not in existing CONTEXT' %
+                               (name, filename))
+            _restore_value(registered[name]._scoped(), key, *pickle.loads(data))
+            nbytes += len(data)
+    return nbytes
+
+def _replay_journal(filename, context):
+    """Apply the journal for context file ``filename`` to the unpickled ``context``"""
+    journal_file = filename + '.journal'
+    if not os.path.exists(journal_file):
+        return
+
+    with open(journal_file, 'rb') as fh:
+        try:
+            header = pickle.load(fh)
+        except Exception:
+            header = None
+        if header != (_JOURNAL_HEADER, _file_id(filename)):
+            # Left over from before the context file was last fully written
+            logger.verbose('Ignoring stale context journal %s' % journal_file)
+            return
+
+        logger.verbose('Replaying context journal %s' % journal_file)
+        while True:
+            try:
+                records = _ContextUnpickler(fh, filename).load()
+            except EOFError:
+                break
+            except Exception:
+                logger.warning('Ignoring incomplete record at end of %s' % journal_file)
+                break
+            for name, key, val, mtime, format in records:
+                if name not in context:
+                    context[name] = ContextDict()
+                _restore_value(context[name], key, val, mtime, format)
 
 class ContextValue(object):
     """Value with context that has a name and modification time.
@@ -117,41 +1541,120 @@ class ContextValue(object):
     :param format: optional format specifier when rendering value
     :param ext: extension to be added when rendering a file context value
     """
+    # Large contexts can hold very many values so avoid a per-instance __dict__
+    __slots__ = ('_val', '_mtime', '_name', 'parent', '_format', 'ext',
+                 '_memo', '_views', '_version')
+
+    # Attributes that are stored by pickle
+    _state_attrs = ('_val', '_mtime', '_name', 'parent', '_format', 'ext')
+
     def __init__(self, val=None, name=None, format=None, ext=None, parent=None):
-        # Possibly inherit attrs (except for 'ext') from an existing ContextValue object
+        # Possibly inherit attrs (except for 'ext') from an existing ContextValue object.
+        # The rendered template memo stays valid for the copy since it has the same _val.
         if isinstance(val, ContextValue):
-            for attr in ('_val', '_mtime', '_name', 'parent', 'format'):
+            for attr in ('_val', '_mtime', '_name', 'parent', '_format', '_memo'):
                 setattr(self, attr, getattr(val, attr))
         else:
             self._val = val
             self._mtime = None if val is None else time.time()
             self._name = name
             self.parent = parent
-            self.format = format
+            self._format = format
+            self._memo = None
 
         self.ext = ext
+        self._views = None
+        self._version = next(_VERSIONS)
+
+    def _scoped(self):
+        """Return the ContextValue that stands for this one in the current
+        ``context_scope()``, which is this value outside of any scope"""
+        scope = _CONTEXT_SCOPE.get()
+        if scope is None or self.parent is None:
+            return self
+        return scope.value(self)
+
+    def _changing(self):
+        """Let the parent ContextDict save the current state before a change, if
+        it has an active snapshot (see ``ContextDict.__enter__``)"""
+        if getattr(self.parent, '_context_manager_cache', None):
+            self.parent._save_value(self)
+
+    def _changed(self):
+        """Record a change of value or format, which invalidates dependent renders"""
+        self._version = next(_VERSIONS)
+        self._memo = None
 
     def clear(self):
         """Clear the value, modification time, and format (set to None)"""
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.clear()
+        self._changing()
         self._val = None
         self._mtime = None
+        self._changed()
 
     def getval(self):
-        return self._val
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.getval()
+        val = self._val
+        if type(val) is _SidecarValue:
+            # Restored from a context sidecar file so load it now
+            val = self._val = val.load()
+        return val
 
     def setval(self, val):
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.setval(val)
+        self._changing()
         if isinstance(val, ContextValue):
             self.__init__(val, ext=val.ext)
         else:
             self._val = val
             self._mtime = time.time()
+            self._changed()
 
     val = property(getval, setval)
     """Set or get with the ``val`` attribute"""
 
+    def getformat(self):
+        return self._scoped()._format
+
+    def setformat(self, format):
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.setformat(format)
+        self._changing()
+        self._format = format
+        self._changed()
+
+    format = property(getformat, setformat)
+    """Format specifier used when rendering a non-string value"""
+
+    def __getstate__(self):
+        # The render memo and extension views are rebuilt on demand
+        return dict((attr, getattr(self, attr)) for attr in self._state_attrs)
+
+    def __setstate__(self, state):
+        # Context files written before __slots__ have the instance __dict__ with
+        # a 'format' attribute.
+        if 'format' in state:
+            state['_format'] = state.pop('format')
+        for attr in self._state_attrs:
+            setattr(self, attr, state.get(attr))
+        self._memo = None
+        self._views = None
+        self._version = next(_VERSIONS)
+
     @property
     def fullname(self):
-        return (self.parent._name + '.' + self.name) if self.parent else self.name
+        parent = self.parent
+        if parent is None or parent._name is None:
+            return self.name
+        return parent._name + '.' + self.name
 
     @property
     def name(self):
@@ -164,8 +1667,16 @@ class ContextValue(object):
     @property
     def mtime(self):
         """Modification time"""
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.mtime
         if self.basedir:
             filename = str(self)
+            if _STATS is not None:
+                _STATS.add('mtime_stat', self.fullname)
+            if _STAT_CACHE is not None:
+                filestat = _STAT_CACHE.stat(os.path.abspath(filename))
+                return None if filestat is None else filestat[stat.ST_MTIME]
             return (os.stat(filename)[stat.ST_MTIME] if os.path.exists(filename) else None)
         else:
             return self._mtime
@@ -174,19 +1685,33 @@ class ContextValue(object):
         return str(self)
 
     def __str__(self):
-        strval = val = self._val
+        scoped = self._scoped()
+        if scoped is not self:
+            return str(scoped)
+        snapshot = _SNAPSHOT.get()
+        if snapshot is None:
+            return self._str()
+
+        if self.parent is not None:
+            key = (id(self.parent), self._name, self.ext)
+        elif isinstance(self._val, str):
+            key = (self._val, self.format)
+        else:
+            return self._str()
+        cached = snapshot.get(key)
+        if cached is None:
+            # Keep a reference to parent so its id cannot be reused within the snapshot
+            cached = snapshot[key] = (self._str(), self.parent)
+        return cached[0]
+
+    def _str(self):
+        strval = val = self.getval()
         if val is None:
             raise ValueError("Context value '%s' is undefined" % self.fullname)
-        template_tag = re.compile(r'{[%{]')
         try:
             # Following line will give TypeError unless val is string-like
-            while (template_tag.search(val)):
-                template = jinja2.Template(val)
-                strval = template.render(CONTEXT)
-                if strval == val:
-                    break
-                else:
-                    val = strval
+            if TEMPLATE_TAG.search(val):
+                strval = self._render_template(val)
         except TypeError:
             strval = (self.format or '%s') % val
 
@@ -194,13 +1719,76 @@ class ContextValue(object):
             # Note that os.path.join(a,b) returns b is b is already absolute
             ext = ('.' + self.ext if self.ext else '')
             strval0 = strval
-            for basedir in self.basedir.split(os.pathsep):
-                strval = pyyaks.fileutil.relpath(os.path.join(basedir, strval0) + ext)
-                if os.path.exists(strval):
-                    break
+            basedirs = self.basedir.split(os.pathsep)
+            if len(basedirs) == 1:
+                strval = pyyaks.fileutil.relpath(os.path.join(basedirs[0], strval0) + ext)
+            else:
+                exists = os.path.exists if _STAT_CACHE is None else _STAT_CACHE.exists
+                for basedir in basedirs:
+                    path = os.path.join(basedir, strval0) + ext
+                    strval = pyyaks.fileutil.relpath(path)
+                    if _STATS is not None:
+                        _STATS.add('basedir_probe', self.fullname)
+                    if exists(path):
+                        break
 
         return strval
 
+    def _render_template(self, val):
+        """Render the template string ``val`` until no further changes occur.
+
+        The result is memoized and reused until one of the ContextValues that the
+        template refers to (directly or through nested templates) is changed.
+        """
+        stats = _STATS
+        memo = self._memo
+        if memo is not None and _memo_valid(memo):
+            if stats is not None:
+                stats.add('render_memo', self.fullname)
+            return memo[0]
+
+        t0 = time.perf_counter()
+        # Guard against a cycle that only shows up at render time, e.g. through a
+        # raw ``.val`` whose output is itself a template.
+        active = getattr(_rendering, 'active', None)
+        if active is None:
+            active = _rendering.active = set()
+        key = (id(self.parent), self._name)
+        if key in active:
+            raise ContextCycleError("Context value '%s' refers to itself" % self.fullname)
+
+        active.add(key)
+        try:
+            # Render referenced templates leaf first so each is rendered only once
+            # and this render finds them already memoized.
+            for value in resolve_order([self])[:-1]:
+                if value._memo is None and isinstance(value._val, str):
+                    value._render_template(value._val)
+
+            sources = []
+            strval = val
+            while TEMPLATE_TAG.search(val):
+                if len(sources) == MAX_RENDER_PASSES:
+                    raise ContextCycleError("Context value '%s' did not resolve after %d passes"
+                                            % (self.fullname, MAX_RENDER_PASSES))
+                sources.append(val)
+                if stats is not None:
+                    stats.add('render_pass', self.fullname)
+                strval = TEMPLATE_CACHE.render(val, _context())
+                if strval == val:
+                    break
+                else:
+                    val = strval
+        finally:
+            active.discard(key)
+
+        deps = _render_deps(sources)
+        if deps is not None:
+            self._memo = (strval,) + deps
+        if stats is not None:
+            stats.add('render', self.fullname, time.perf_counter() - t0)
+        return strval
+
     def __fspath__(self):
         """ABC os.PathLike interface ContextValue is directly useable in Path or
         os.path or open, etc.
@@ -231,18 +1819,58 @@ class ContextValue(object):
         linux PATH.  The first base path for which the content file path exists is
         returned, or if none exist then the last absolute path will be returned.
         """
-        return str(self._val) if (self.basedir is None) else  os.path.abspath(str(self))
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.abs
+        return str(self.getval()) if (self.basedir is None) else  os.path.abspath(str(self))
 
     def __getattr__(self, ext):
         """Interpret an unfound attribute lookup as a file extension.
         A new ContextValue object with that extension is returned.
         """
         # pickle looks for some specific attributes beginning with __ and expects
-        # AttributeError if they are not provided by class.
-        if ext.startswith('__'):
-            raise AttributeError
+        # AttributeError if they are not provided by class.  Unset slots (e.g.
+        # while unpickling) also arrive here.
+        if ext.startswith('_'):
+            raise AttributeError(ext)
+        else:
+            return self._scoped()._view(ext)
+
+    def _view(self, ext):
+        """Return a ContextValue copy of this value with extension ``ext``.
+
+        Views are interned per value and reused as long as neither this value
+        nor the view itself has been changed since the view was made.
+        """
+        views = self._views
+        if views is None:
+            views = self._views = {}
         else:
-            return ContextValue(val=self, ext=ext)
+            entry = views.get(ext)
+            if entry is not None:
+                version, view, view_version = entry
+                if version == self._version and view._version == view_version:
+                    return view
+
+        view = ContextValue(val=self, ext=ext)
+        views[ext] = (self._version, view, view._version)
+        return view
+
+# Marks a key created within a ContextDict snapshot
+_NEW_KEY = object()
+
+class _AccessorAttribute(object):
+    """ContextDict class attribute that returns a _ContextDictAccessor for ``attr``"""
+    def __init__(self, attr):
+        self.attr = attr
+
+    def __get__(self, contextdict, cls=None):
+        if contextdict is None:
+            return self
+        return _ContextDictAccessor(contextdict, self.attr)
+
+# Splits a ContextDict key like 'evt2.fits' into base key and extension
+_KEY_EXT = re.compile(r'([^.]+)\.(.+)')
 
 class ContextDict(dict):
     """Dictionary class that automatically registers the dict in the module
@@ -254,46 +1882,100 @@ class ContextDict(dict):
     :param basedir: base directory for file context
     """
     def __new__(cls, name=None, basedir=None):
-        if name in CONTEXT:
-            if basedir != CONTEXT[name].basedir:
+        registered = _context()
+        if name in registered:
+            if basedir != registered[name].basedir:
                 raise ValueError("Re-using context name '{}' but basedirs don't match "
-                                 "({} vs. {})".format(name, basedir, CONTEXT[name].basedir))
-            return CONTEXT[name]
+                                 "({} vs. {})".format(name, basedir, registered[name].basedir))
+            return registered[name]
 
         self = super(ContextDict, cls).__new__(cls)
+        scope = _CONTEXT_SCOPE.get()
+        if scope is not None:
+            # Made within a context scope so this is already private to the scope
+            scope.add(self)
         if name is not None:
-            CONTEXT[name] = self
+            (CONTEXT if scope is None else scope.names)[name] = self
         self._name = name
+        self._version = next(_VERSIONS)
         self.basedir = basedir
         self._context_manager_cache = []
-        for attr in ('val', 'rel', 'abs', 'format'):
-            setattr(self, attr, _ContextDictAccessor(self, attr))
         return self
 
+    def _scoped(self):
+        """Return the ContextDict that stands for this one in the current
+        ``context_scope()``, which is this dict outside of any scope"""
+        scope = _CONTEXT_SCOPE.get()
+        return self if scope is None else scope.get(self)
+
+    def _fork(self):
+        """Return an unregistered copy of this ContextDict and its values for a
+        context scope"""
+        fork = super(ContextDict, type(self)).__new__(type(self))
+        fork._name = self._name
+        fork._version = next(_VERSIONS)
+        fork._basedir = self._basedir
+        fork._context_manager_cache = []
+        for key, value in dict.items(self):
+            copy = ContextValue(value, ext=value.ext)
+            copy.parent = fork
+            # The memo depends on the values of this dict, not the fork
+            copy._memo = None
+            dict.__setitem__(fork, key, copy)
+        return fork
+
     def __init__(self, *args, **kwargs):
         # Initialization is done in __new__, so don't do anything here
         pass
 
+    # Class of the ContextValues made for keys of this ContextDict
+    _value_class = ContextValue
+
+    # Accessors like src.val.joe are made on demand instead of being stored
+    # in every ContextDict
+    val = _AccessorAttribute('val')
+    rel = _AccessorAttribute('rel')
+    abs = _AccessorAttribute('abs')
+    format = _AccessorAttribute('format')
+
     def __getitem__(self, key):
         """Get key value from the ContextDict.  For a ContextDict with base
         then allow for extensions on key.
         """
-        match = re.match(r'([^.]+)\.(.+)', key)
-        base, ext = match.groups() if match else (key, None)
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped[key]
 
-        # Autogenerate an entry for key
-        if base not in self:
-            value = ContextValue(val=None, name=base, parent=self)
+        if '.' in key:
+            match = _KEY_EXT.match(key)
+            base, ext = match.groups() if match else (key, None)
+        else:
+            base, ext = key, None
+
+        try:
+            baseContextValue = dict.__getitem__(self, base)
+        except KeyError:
+            # Autogenerate an entry for key
+            baseContextValue = self._value_class(val=None, name=base, parent=self)
+            if _STATS is not None:
+                _STATS.add('autogen', baseContextValue.fullname)
             logger.debug('Autogen %s with name=%s basedir=%s' %
-                         (repr(value), base, self.basedir))
-            dict.__setitem__(self, base, value)
+                         (repr(baseContextValue), base, self.basedir))
+            if self._context_manager_cache:
+                self._context_manager_cache[-1].setdefault(base, _NEW_KEY)
+            dict.__setitem__(self, base, baseContextValue)
+            self._version = next(_VERSIONS)
 
-        baseContextValue = dict.__getitem__(self, base)
-        return (ContextValue(baseContextValue, ext=ext) if ext else baseContextValue)
+        return (baseContextValue._view(ext) if ext else baseContextValue)
 
     def __setitem__(self, key, val):
+        scoped = self._scoped()
+        if scoped is not self:
+            scoped[key] = val
+            return
+
         # If ContextValue was already init'd then just update val
-        if key in self:
+        if dict.__contains__(self, key):
             value = dict.__getitem__(self, key)
             logger.debug('Setting value %s with name=%s val=%s basedir=%s' %
                          (repr(value), repr(key), repr(val), self.basedir))
@@ -301,10 +1983,59 @@ class ContextDict(dict):
         else:
             if '.' in key:
                 raise ValueError('Dot not allowed in ContextDict key ' + key)
-            value = ContextValue(val=val, name=key, parent=self)
+            value = self._value_class(val=val, name=key, parent=self)
             logger.debug('Creating value %s with name=%s val=%s basedir=%s' %
                          (repr(value), repr(key), repr(val), self.basedir))
+            if self._context_manager_cache:
+                self._context_manager_cache[-1].setdefault(key, _NEW_KEY)
             dict.__setitem__(self, key, value)
+            self._version = next(_VERSIONS)
+
+    def __delitem__(self, key):
+        scoped = self._scoped()
+        if scoped is not self:
+            del scoped[key]
+            return
+
+        if self._context_manager_cache:
+            self._save_value(dict.__getitem__(self, key))
+        dict.__delitem__(self, key)
+        self._version = next(_VERSIONS)
+
+    def _save_value(self, value):
+        """Save the state of ``value`` in the innermost snapshot unless it was
+        already saved there.  Extension views are not stored in the dict and are
+        ignored."""
+        frame = self._context_manager_cache[-1]
+        key = value._name
+        if key not in frame and dict.get(self, key) is value:
+            frame[key] = (value, value._val, value._mtime, value._format, value.parent)
+
+    def _push_snapshot(self):
+        """Start recording the original state of values changed from now on"""
+        self._context_manager_cache.append({})
+
+    def _pop_snapshot(self):
+        """Restore every value changed since the matching ``_push_snapshot()`` and
+        delete keys that were created since then"""
+        frame = self._context_manager_cache.pop()
+        outer = self._context_manager_cache[-1] if self._context_manager_cache else None
+
+        for key, saved in frame.items():
+            # The enclosing snapshot needs the state from before this one
+            if outer is not None:
+                outer.setdefault(key, saved)
+
+            if saved is _NEW_KEY:
+                dict.pop(self, key, None)
+            else:
+                value = saved[0]
+                value._val, value._mtime, value._format, value.parent = saved[1:]
+                value._changed()
+                dict.__setitem__(self, key, value)
+
+        if frame:
+            self._version = next(_VERSIONS)
 
     def __enter__(self):
         """
@@ -313,39 +2044,33 @@ class ContextDict(dict):
           context_val = Context('context_val')
           with context_val:
               pass
+
+        This is a copy-on-write snapshot: only values that are set, cleared,
+        reformatted, created or deleted within the block are saved and restored,
+        so the cost does not depend on the size of the ContextDict.  Note that a
+        value which is modified in place (e.g. adding a key to a dict value)
+        is not restored.
         """
-        # Push a copy of self onto a stack
-        self._context_manager_cache.append(deepcopy(self))
+        self._scoped()._push_snapshot()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # Pop the most recent cached version and update self
-        self_cache = self._context_manager_cache.pop()
-        self.update(self_cache)
-
-        # Delete any keys now in self that weren't in the cached version
-        delkeys = [key for key in self if key not in self_cache]
-        for key in delkeys:
-            del self[key]
+        self._scoped()._pop_snapshot()
 
     def cache(self, func):
         """
-        Decorator to cache this ContextDict object
+        Decorator to cache this ContextDict object.  This uses the same
+        copy-on-write snapshot as the context manager.
         """
         import functools
 
         @functools.wraps(func)
         def wrap_func(*args, **kwargs):
-            self_cache = deepcopy(self)
-
+            cdict = self._scoped()
+            cdict._push_snapshot()
             try:
                 result = func(*args, **kwargs)
             finally:
-                # Restore to self_cache and delete any keys now in self that weren't in the
-                # cached version
-                self.update(self_cache)
-                delkeys = [key for key in self if key not in self_cache]
-                for key in delkeys:
-                    del self[key]
+                cdict._pop_snapshot()
 
             return result
 
@@ -360,16 +2085,54 @@ class ContextDict(dict):
     def __repr__(self):
         return str(dict((key, self[key].val) for key in self))
 
+    def render_all(self):
+        """Render every defined value in this ContextDict against a single frozen
+        snapshot of the current context (see ``render_many()``).  File values are
+        rendered as relative paths.
+
+        :returns: dict of rendered values keyed by ContextDict key
+        """
+        with _frozen_context():
+            return dict((key, str(value)) for key, value in dict.items(self._scoped())
+                        if value._val is not None)
+
     def clear(self):
         """Clear all values in dictionary.  The keys are not deleted so that
         ContextValue references in task decorators maintain validity."""
-        for key in self:
-            dict.__getitem__(self, key).clear()
+        for value in dict.values(self._scoped()):
+            value.clear()
+
+    # Reads of the dict contents go to the fork in a context scope
+    def __contains__(self, key):
+        return dict.__contains__(self._scoped(), key)
+
+    def __iter__(self):
+        return dict.__iter__(self._scoped())
+
+    def __len__(self):
+        return dict.__len__(self._scoped())
+
+    def keys(self):
+        return dict.keys(self._scoped())
+
+    def values(self):
+        return dict.values(self._scoped())
+
+    def items(self):
+        return dict.items(self._scoped())
+
+    def get(self, key, default=None):
+        return dict.get(self._scoped(), key, default)
 
     def get_basedir(self):
-        return self._basedir
+        return self._scoped()._basedir
 
     def set_basedir(self, val):
+        scoped = self._scoped()
+        if scoped is not self:
+            scoped.basedir = val
+            return
+
         if val is None:
             self._basedir = None
         else:
@@ -378,6 +2141,7 @@ class ContextDict(dict):
             non_windows_colon = re.compile(r':(?=[^\\])')
             vals = [os.path.abspath(x) for x in non_windows_colon.split(val)]
             self._basedir = os.pathsep.join(vals)
+        self._version = next(_VERSIONS)
 
     basedir = property(get_basedir, set_basedir)
 
@@ -398,10 +2162,19 @@ class _ContextDictAccessor(object):
       print files.rel.jane
       print files.abs.jane
     """
+    __slots__ = ('_contextdict', '_attr')
+
     def __init__(self, contextdict, attr):
         object.__setattr__(self, '_contextdict', contextdict)
         object.__setattr__(self, '_attr', attr)
 
+    def __setstate__(self, state):
+        # Context files written before __slots__ hold the instance __dict__
+        if isinstance(state, tuple):
+            state = state[1]
+        for attr, value in state.items():
+            object.__setattr__(self, attr, value)
+
     def __getattr__(self, name):
         # pickle looks for some specific attributes beginning with __ and expects
         # AttributeError if they are not provided by class.
@@ -418,3 +2191,347 @@ class _ContextDictAccessor(object):
 
     def __setitem__(self, name, value):
         self.__setattr__(name, value)
+
+class _Layer(object):
+    """Values and render memos of one layer of a LayeredContextDict.  Each
+    value is a [val, mtime, format, version] list keyed by ContextDict key."""
+    __slots__ = ('values', 'memos')
+
+    def __init__(self, values=None):
+        self.values = {} if values is None else values
+        self.memos = {}
+
+
+class _LayeredValue(ContextValue):
+    """ContextValue of a LayeredContextDict.  The value state is kept in the
+    layers of the parent and read from the current layer, falling back to the
+    default layer.  The object itself stays the same for all layers so it can
+    be given to task decorators."""
+    __slots__ = ()
+
+    def __init__(self, val=None, name=None, format=None, ext=None, parent=None):
+        self._name = name
+        self.parent = parent
+        self.ext = ext
+        self._views = None
+
+        defaults = parent._defaults.values
+        if name in defaults:
+            # Left over from a key deleted at the end of a ContextDict snapshot
+            for layer in parent._layers.values():
+                layer.values.pop(name, None)
+        defaults[name] = [None, None, format, next(_VERSIONS)]
+        if isinstance(val, ContextValue):
+            val, mtime, format = val._val, val._mtime, val._format
+        else:
+            mtime = None if val is None else time.time()
+        if val is not None or format is not None:
+            self._entry(write=True)[:] = [val, mtime, format, next(_VERSIONS)]
+
+    def _entry(self, write=False):
+        """Return the state list of this value in the current layer.  With
+        ``write`` a default value is first copied to the current layer."""
+        parent = self.parent
+        layer = parent._layer
+        if layer is not None:
+            entry = layer.values.get(self._name)
+            if entry is not None:
+                return entry
+            if write:
+                entry = layer.values[self._name] = list(parent._defaults.values[self._name])
+                return entry
+        return parent._defaults.values[self._name]
+
+    def _get_field(idx):
+        def get(self):
+            return self._entry()[idx]
+
+        def set(self, val):
+            self._entry(write=True)[idx] = val
+
+        return property(get, set)
+
+    _val = _get_field(0)
+    _mtime = _get_field(1)
+    _format = _get_field(2)
+    _version = _get_field(3)
+    del _get_field
+
+    @property
+    def _memo(self):
+        parent = self.parent
+        return (parent._layer or parent._defaults).memos.get(self._name)
+
+    @_memo.setter
+    def _memo(self, memo):
+        parent = self.parent
+        (parent._layer or parent._defaults).memos[self._name] = memo
+
+    def setval(self, val):
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.setval(val)
+        self._changing()
+        if isinstance(val, ContextValue):
+            self._val, self._mtime, self._format = val._val, val._mtime, val._format
+        else:
+            self._val = val
+            self._mtime = time.time()
+        self._changed()
+
+    val = property(ContextValue.getval, setval)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as a plain ContextValue with the current state
+        value = ContextValue(self, ext=self.ext)
+        return (ContextValue, (), value.__getstate__())
+
+
+class LayeredContextDict(ContextDict):
+    """ContextDict with a layer of default values and any number of named
+    layers of values on top of it, only one of which is in use at a time::
+
+      src = LayeredContextDict('src')
+      src['survey'] = 'DSS'        # default for every source
+      for row in sources:
+          src.use_layer(row['id'])
+          src['id'] = row['id']    # set in the layer for this source only
+          print(src['survey'])     # DSS from the default layer
+
+    A value that is read and not set in the current layer comes from the
+    default layer, and setting it copies it to the current layer.  Switching
+    layers does not copy or change any values and each layer keeps its own
+    render memos, so switching back to a layer is cheap and its values can be
+    compared with those of other layers.  The ContextValue objects are the same
+    for every layer and rendering, accessors like ``src.val.id``, task
+    decorators and ``store_context()`` see the current layer.  A pickled
+    LayeredContextDict is a plain ContextDict with the current values.
+
+    :param name: name by which dictionary is registered in context.
+    :param basedir: base directory for file context
+    """
+    _value_class = _LayeredValue
+
+    def __new__(cls, name=None, basedir=None):
+        registered = _context()
+        if name in registered and not isinstance(registered[name], LayeredContextDict):
+            raise ValueError("Context name '{}' is already used by a ContextDict"
+                             .format(name))
+        self = super(LayeredContextDict, cls).__new__(cls, name, basedir)
+        if '_defaults' not in self.__dict__:
+            self._defaults = _Layer()
+            self._layers = {}
+            self._layer = None
+            self._layer_key = None
+        return self
+
+    def _fork(self):
+        fork = super(LayeredContextDict, self)._fork()
+        fork._defaults = _Layer(dict((key, list(entry))
+                                     for key, entry in self._defaults.values.items()))
+        fork._layers = dict((key, _Layer(dict((k, list(entry))
+                                              for k, entry in layer.values.items())))
+                            for key, layer in self._layers.items())
+        fork._layer_key = self._layer_key
+        fork._layer = fork._layers.get(self._layer_key)
+        for key in dict.keys(fork):
+            value = _LayeredValue.__new__(_LayeredValue)
+            value._name = key
+            value.parent = fork
+            value.ext = None
+            value._views = None
+            dict.__setitem__(fork, key, value)
+        return fork
+
+    def use_layer(self, key):
+        """Make layer ``key`` the current layer, creating it if needed.  With
+        ``key=None`` only the default layer is used, so values are set as
+        defaults.
+
+        :param key: hashable layer key (e.g. a source id) or None
+        :returns: key of the previous layer
+        """
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.use_layer(key)
+
+        prev = self._layer_key
+        if key is None:
+            self._layer = None
+        else:
+            layer = self._layers.get(key)
+            if layer is None:
+                layer = self._layers[key] = _Layer()
+            self._layer = layer
+        self._layer_key = key
+        return prev
+
+    @property
+    def layer(self):
+        """Key of the current layer (None if only the default layer is in use)"""
+        return self._scoped()._layer_key
+
+    @property
+    def layers(self):
+        """Keys of all the layers other than the default layer"""
+        return list(self._scoped()._layers)
+
+    def drop_layer(self, key):
+        """Delete layer ``key`` and its values.  If it is the current layer then
+        only the default layer is used afterward.
+
+        :param key: layer key
+        """
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.drop_layer(key)
+
+        del self._layers[key]
+        if self._layer_key == key:
+            self.use_layer(None)
+
+    def clear(self):
+        """Clear the values set in the current layer so that the defaults are
+        seen again.  With only the default layer in use clear all values."""
+        scoped = self._scoped()
+        if scoped is not self:
+            return scoped.clear()
+
+        if self._layer is None:
+            super(LayeredContextDict, self).clear()
+        else:
+            for key in list(self._layer.values):
+                value = dict.__getitem__(self, key)
+                value._changing()
+                del self._layer.values[key]
+            self._layer.memos.clear()
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as a plain ContextDict with the current values.  The value
+        # parent is this object, which is unpickled as the plain ContextDict.
+        state = dict(_name=self._name, _version=self._version, _basedir=self._basedir,
+                     _context_manager_cache=[])
+        items = [(key, ContextValue(value)) for key, value in self.items()]
+        return (ContextDict, (), state, None, iter(items))
+
+
+class SourceCursor(object):
+    """Bind a ContextDict to the rows of a table and set its values from one row
+    at a time.  This replaces the per-source ``src.clear()`` and
+    ``src.update(zip(cols, row))`` of a pipeline driver::
+
+      src = ContextDict('src')
+      src.format.ra = '%.4f'
+      for irow in SourceCursor(src, 'sources.csv'):
+          run_pipeline()    # src.val.ra, src.val.dec etc are from row irow
+
+    The table columns are converted once to lists of Python values and the
+    ContextValue for each column is created once, so moving to a row just sets
+    the value of each column ContextValue.  Formats and other attributes of the
+    ContextValues are kept.
+
+    The ``table`` can be a NumPy structured array, a FITS-like table with
+    ``colnames`` (e.g. astropy Table), a dict of columns, the name of a CSV file
+    with a header line, or a sequence of row tuples with the column ``names``.
+    CSV values are converted to int or float where possible.
+
+    :param contextdict: ContextDict to set
+    :param table: table of source values
+    :param names: column names (default=all, required for a sequence of rows)
+    :param clear: clear the other values of ``contextdict`` on each move (default=True)
+    """
+    def __init__(self, contextdict, table, names=None, clear=True):
+        self.contextdict = contextdict
+        self.clear = clear
+        self.row = None
+
+        columns = self._get_columns(table, names)
+        lengths = set(len(col) for col in columns.values())
+        if len(lengths) > 1:
+            raise ValueError('table columns have different lengths')
+        self._len = lengths.pop() if lengths else 0
+
+        self._cdict = contextdict._scoped()
+        self._columns = []
+        for name, col in columns.items():
+            if name not in self._cdict:
+                self._cdict[name] = None
+            self._columns.append((dict.__getitem__(self._cdict, name), col))
+
+    @staticmethod
+    def _get_columns(table, names):
+        """Return dict of column name => list of Python values"""
+        if isinstance(table, (str, os.PathLike)):
+            import csv
+            with open(table, newline='') as fh:
+                rows = list(csv.reader(fh))
+            header, rows = rows[0], rows[1:]
+            cols = zip(*rows) if rows else [()] * len(header)
+            columns = dict((name.strip(), [_csv_value(x) for x in col])
+                           for name, col in zip(header, cols))
+        elif getattr(getattr(table, 'dtype', None), 'names', None):
+            columns = dict((name, table[name].tolist()) for name in table.dtype.names)
+        elif hasattr(table, 'colnames'):
+            columns = dict((name, table[name]) for name in table.colnames)
+        elif hasattr(table, 'keys'):
+            columns = dict((name, table[name]) for name in table.keys())
+        else:
+            if names is None:
+                raise ValueError('names must be given for a table of rows')
+            cols = list(zip(*table)) or [()] * len(names)
+            return dict((name, list(col)) for name, col in zip(names, cols))
+
+        if names is not None:
+            columns = dict((name, columns[name]) for name in names)
+        return dict((name, col.tolist() if hasattr(col, 'tolist') else list(col))
+                    for name, col in columns.items())
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for irow in range(self._len):
+            self.move(irow)
+            yield irow
+
+    def move(self, irow):
+        """Set the ContextDict values from row ``irow`` of the table.
+
+        :param irow: row index
+        """
+        if irow < 0:
+            irow += self._len
+        if not 0 <= irow < self._len:
+            raise IndexError('row {} out of range for table of length {}'
+                             .format(irow, self._len))
+
+        cdict = self.contextdict._scoped()
+        columns = self._columns
+        if cdict is not self._cdict:
+            # Within a different context scope so set the values of that scope
+            columns = [(dict.__getitem__(cdict, value._name), col) for value, col in columns]
+        column_ids = set(id(value) for value, col in columns)
+
+        snapshot = bool(cdict._context_manager_cache)
+        if self.clear:
+            for value in dict.values(cdict):
+                if value._val is not None and id(value) not in column_ids:
+                    value.clear()
+
+        mtime = time.time()
+        for value, col in columns:
+            if snapshot:
+                cdict._save_value(value)
+            value._val = col[irow]
+            value._mtime = mtime
+            value._changed()
+        self.row = irow
+
+def _csv_value(val):
+    """Convert CSV string ``val`` to int or float if possible"""
+    for type_ in (int, float):
+        try:
+            return type_(val)
+        except ValueError:
+            pass
+    return val
@@ -1,6 +1,7 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 """Pyyaks file utilities"""
 import os
+import time
 import tempfile
 import shutil
 import re
@@ -8,6 +9,16 @@ import shutil
 import glob
 import gzip
 import logging
+import functools
+import hashlib
+import pickle
+import uuid
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -38,6 +49,189 @@ class TempDir(object):
         """Remove the temp directory when the object is destroyed."""
         shutil.rmtree(self.__dirname)
 
+class StatCache(object):
+    """Cache of ``os.stat()`` results for file existence and modification time
+    checks, intended for slow (e.g. NFS) file systems where each check is a
+    metadata round trip.  Paths are used as given so callers should supply
+    absolute paths.
+    ::
+
+      >>> cache = pyyaks.fileutil.StatCache(ttl=60)
+      >>> cache.exists('/usr/bin/env')
+      True
+      >>> cache.invalidate()
+
+    :param ttl: seconds that a cached result stays valid (default=None => until invalidated)
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._stats = {}
+
+    def stat(self, path):
+        """Return ``os.stat(path)`` or None if ``path`` does not exist."""
+        now = time.time()
+        try:
+            result, stat_time = self._stats[path]
+        except KeyError:
+            pass
+        else:
+            if self.ttl is None or now - stat_time < self.ttl:
+                return result
+
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        self._stats[path] = (result, now)
+        return result
+
+    def exists(self, path):
+        """Return True if ``path`` exists."""
+        return self.stat(path) is not None
+
+    def invalidate(self, path=None):
+        """Forget the cached result for ``path`` or for all paths if ``path`` is None."""
+        if path is None:
+            self._stats.clear()
+        else:
+            self._stats.pop(path, None)
+
+@contextlib.contextmanager
+def _file_lock(filename, exclusive=False):
+    """Hold a shared or exclusive lock on lock file ``filename`` (no locking
+    where fcntl is not available)"""
+    if fcntl is None:
+        yield
+        return
+    with open(filename, 'a') as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+class FingerprintCache(object):
+    """Persistent cache of file content digests.  The digest of a file is
+    computed again only if the inode, size or modification time (in ns) of the
+    file has changed since it was cached, so unchanged files are never re-read.
+    The cache also holds named sets of digests, e.g. the digests of the
+    depends of a task at the last successful run.
+
+    Several processes can share a cache file.  ``save()`` reads the file again
+    under an exclusive lock on ``filename + '.lock'`` and writes the digests
+    and records changed by this cache on top of those saved by other
+    processes.  A cache file that cannot be read is treated as empty.
+    ::
+
+      >>> cache = pyyaks.fileutil.FingerprintCache('fingerprints.pkl')
+      >>> len(cache.digest('/usr/bin/env'))
+      40
+      >>> cache.save()
+
+    :param filename: file holding the cache (default=None => not persistent)
+    :param algorithm: hashlib algorithm name for digests
+    :param blocksize: number of bytes read at a time when computing a digest
+    """
+    def __init__(self, filename=None, algorithm='sha1', blocksize=1 << 20):
+        self.filename = filename
+        self.algorithm = algorithm
+        self.blocksize = blocksize
+        self._digests, self._records = self._load()
+        self._dirty = False
+        # Digests and records in the cache file, for the changes to save
+        self._saved = self.snapshot()
+
+    def _load(self):
+        """Return the digests and records in ``filename``"""
+        if self.filename is None or not os.path.exists(self.filename):
+            return {}, {}
+        try:
+            with open(self.filename, 'rb') as fh:
+                state = pickle.load(fh)
+            if state.get('algorithm') != self.algorithm:
+                return {}, {}
+            return dict(state['digests']), dict(state['records'])
+        except Exception as err:
+            logger.warning('Ignoring unreadable fingerprint cache %s: %s'
+                           % (self.filename, err))
+            return {}, {}
+
+    def digest(self, path):
+        """Return the hex digest of the content of file ``path`` or None if
+        ``path`` does not exist."""
+        try:
+            filestat = os.stat(path)
+        except OSError:
+            return None
+        key = (filestat.st_ino, filestat.st_size, filestat.st_mtime_ns)
+        entry = self._digests.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        hasher = hashlib.new(self.algorithm)
+        with open(path, 'rb') as fh:
+            for block in iter(functools.partial(fh.read, self.blocksize), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        self._digests[path] = (key, digest)
+        self._dirty = True
+        return digest
+
+    def record(self, name, digests):
+        """Record the dict of ``digests`` under ``name``."""
+        if self._records.get(name) != digests:
+            self._records[name] = digests
+            self._dirty = True
+
+    def recorded(self, name):
+        """Return the digests recorded under ``name`` or None."""
+        return self._records.get(name)
+
+    def snapshot(self):
+        """Return a copy of the cached digests and records for ``changes()``."""
+        return dict(self._digests), dict(self._records)
+
+    def changes(self, snapshot):
+        """Return the digests and records that have changed since ``snapshot``
+        was taken, for ``merge()`` into another cache."""
+        digests, records = snapshot
+        return (dict((path, entry) for path, entry in self._digests.items()
+                     if digests.get(path) != entry),
+                dict((name, entry) for name, entry in self._records.items()
+                     if records.get(name) != entry))
+
+    def merge(self, changes):
+        """Add the digests and records from ``changes()`` of another cache."""
+        digests, records = changes
+        if digests or records:
+            self._digests.update(digests)
+            self._records.update(records)
+            self._dirty = True
+
+    def save(self):
+        """Write the cache to ``filename`` if anything has changed, keeping
+        the digests and records saved by other caches of the same file."""
+        if self.filename is None or not self._dirty:
+            return
+        with _file_lock(self.filename + '.lock', exclusive=True):
+            digests, records = self._load()
+            changed_digests, changed_records = self.changes(self._saved)
+            digests.update(changed_digests)
+            records.update(changed_records)
+            state = dict(algorithm=self.algorithm, digests=digests, records=records)
+            tmpname = '%s.%s.tmp' % (self.filename, uuid.uuid4().hex[:12])
+            try:
+                with open(tmpname, 'wb') as fh:
+                    pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, self.filename)
+            except BaseException:
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
+                raise
+        self._digests, self._records = digests, records
+        self._saved = self.snapshot()
+        self._dirty = False
+
 def get_globfiles(fileglob, minfiles=1, maxfiles=1):
     """
     Get file(s) matching ``fileglob``.  If the number of matching
@@ -79,10 +273,58 @@ def relpath(path, cwd=None):
     """
     if cwd is None:
         cwd = os.getcwd()
+    elif not os.path.isabs(cwd):
+        cwd = os.path.abspath(cwd)
+
+    if type(path) is str:
+        return _relpath_cached(path, cwd)
+    return _relpath(path, cwd)
+
+def relpaths(paths, cwd=None):
+    """Find relative paths from current directory to each of ``paths``.
+
+    This is the same as ``[relpath(x, cwd) for x in paths]`` but the current
+    directory is looked up only once.  If ``paths`` is a NumPy array then a
+    string array of the same shape is returned.
+
+    Example usage::
+
+      >>> from pyyaks.fileutil import relpaths
+      >>> relpaths(['/a/b/hello', '/a/b/c/d/there'], cwd='/a/b/c/d')
+      ['../../hello', 'there']
 
-    currpath = os.path.abspath(cwd)
+    :param paths: sequence or NumPy array of destination paths
+    :param cwd: Current directory (default: os.getcwd() )
+    :rtype: list or NumPy array of relative paths
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    elif not os.path.isabs(cwd):
+        cwd = os.path.abspath(cwd)
+
+    shape = getattr(paths, 'shape', None)
+    if shape is not None:
+        paths = paths.ravel().tolist()
+    out = [(_relpath_cached if type(path) is str else _relpath)(path, cwd)
+           for path in paths]
+
+    if shape is not None:
+        import numpy as np
+        out = np.array(out, dtype=str).reshape(shape)
+    return out
+
+@functools.lru_cache(maxsize=64)
+def _cwd_parts(cwd):
+    return cwd.split(os.sep)
+
+def _relpath(path, cwd):
+    """Relative path from absolute directory ``cwd`` to ``path``."""
+    currpath = os.path.normpath(cwd)
     destpath = os.path.abspath(os.path.join(cwd, path))
-    currpaths = currpath.split(os.sep)
+    if destpath == currpath:
+        return ''
+
+    currpaths = _cwd_parts(currpath)
     destpaths = destpath.split(os.sep)
 
     # Don't go up to root and back.  Since we split() on an abs path the
@@ -90,15 +332,20 @@ def relpath(path, cwd=None):
     if currpaths[1] != destpaths[1]:
         return destpath
 
-    # Get rid of common path elements
-    while currpaths and destpaths and currpaths[0] == destpaths[0]:
-        currpaths.pop(0)
-        destpaths.pop(0)
+    # Number of leading path elements in common (including the root '')
+    try:
+        common = os.path.commonpath([currpath, destpath])
+    except ValueError:
+        return destpath
+    ncommon = len(common.rstrip(os.sep).split(os.sep))
 
     # start with enough '..'s to get to top of common path then get
-    # the rest of the destpaths.  Return '' if the list ends up being empty.
-    relpaths = [os.pardir] * len(currpaths) + destpaths
-    return os.path.join(*relpaths) if relpaths else ''
+    # the rest of the destpaths.
+    relpaths = [os.pardir] * (len(currpaths) - ncommon) + destpaths[ncommon:]
+    return os.path.join(*relpaths)
+
+# The relative path only depends on the two strings so memoize per (path, cwd)
+_relpath_cached = functools.lru_cache(maxsize=4096)(_relpath)
 
 def make_local_copy(infile, outfile=None, copy=False, linkabs=False, clobber=True):
     """
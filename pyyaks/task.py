@@ -10,11 +10,31 @@ import re
 import time
 import traceback
 import logging
+import functools
+import hashlib
+import json
+import collections
+import multiprocessing
+import threading
+import contextvars
+import concurrent.futures
+from collections.abc import MutableMapping
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import pyyaks.context
+import pyyaks.fileutil
 import pyyaks.logger
 import pyyaks.shell
-import collections
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -24,9 +44,39 @@ logger = logging.getLogger('pyyaks')
 logger.addHandler(NullHandler())
 logger.propagate = False
 
+def _new_status():
+    return dict(fail=False,
+                context_file=None,
+                context_journal=False,
+                context_background=False,
+                fingerprints=None,
+                build_log=None,
+                failed_tasks=[],
+                timings=[])
+
+class _Status(MutableMapping):
+    """Status of the current set of tasks, kept separately for each
+    ``pyyaks.context.context_scope()``"""
+    def _status(self):
+        return pyyaks.context.scope_local('pyyaks.task.status', _new_status)
+
+    def __getitem__(self, key):
+        return self._status()[key]
+
+    def __setitem__(self, key, val):
+        self._status()[key] = val
+
+    def __delitem__(self, key):
+        del self._status()[key]
+
+    def __iter__(self):
+        return iter(self._status())
+
+    def __len__(self):
+        return len(self._status())
+
 # Module var for maintaining status of current set of tasks
-status = dict(fail=False,
-              context_file=None)
+status = _Status()
 
 class DependMissing(Exception):
     pass
@@ -133,6 +183,10 @@ def check_depend(depends=None, targets=None):
 class TaskDecor(object):
     """Base class for generating task decorators."""
 
+    # Set for decorators that change process-wide state (e.g. the current
+    # directory) so that a Pipeline never runs the task alongside other tasks
+    serial = False
+
     def setup(self):
         pass
 
@@ -155,8 +209,11 @@ class TaskDecor(object):
             finally:
                 self.teardown()
 
-        new_func.__name__ = func.__name__
-        new_func.__doc__ = func.__doc__
+        # This also carries over the depends, targets and serial attributes used
+        # by Pipeline from decorators applied below this one
+        functools.update_wrapper(new_func, func)
+        if self.serial:
+            new_func.serial = True
         return new_func
 
 class chdir(TaskDecor):
@@ -164,7 +221,8 @@ class chdir(TaskDecor):
 
     :param newdir: directory
     """
-    
+    serial = True
+
     def __init__(self, newdir):
         self.newdir = newdir
         
@@ -183,7 +241,8 @@ class setenv(TaskDecor):
 
     :param env: dict of environment values
     """
-    
+    serial = True
+
     def __init__(self, env):
         self.env = env
 
@@ -198,11 +257,210 @@ class setenv(TaskDecor):
         os.environ.update(self.origenv)
         logger.debug('Restored local environment')
 
+def _dep_path(dep):
+    """Return the absolute file name of file depend or target ``dep`` or None
+    for a ContextValue that is not a file"""
+    if isinstance(dep, pyyaks.context.ContextValue):
+        return dep.abs if dep.basedir else None
+    return os.path.abspath(dep)
+
+def _targets_key(targets):
+    """Return the key identifying a set of ``targets`` in a fingerprint cache"""
+    return tuple(sorted(_dep_path(dep) or dep.fullname for dep in targets))
+
+def _targets_exist(targets):
+    for dep in targets:
+        path = _dep_path(dep)
+        if not (os.path.exists(path) if path else dep.mtime is not None):
+            return False
+    return True
+
+class BuildLog(object):
+    """Log of the depends of each set of task targets at the last successful
+    run of the task, similar to the ninja build log.  Each depend file is
+    recorded with its modification time (ns) and each other ContextValue with
+    its value.  Records are appended to ``filename`` as lines of JSON so that a
+    run which is interrupted keeps the records of the tasks that finished.
+
+    Several processes can share a build log (e.g. the workers of
+    ``run_sources()``).  Each record is appended under a shared lock on
+    ``filename + '.lock'`` and ``refresh()`` reads the records appended by other
+    processes.  ``close()`` compacts the log under an exclusive lock.  Use
+    ``get_build_log()`` to share one BuildLog object within a process.
+
+    :param filename: build log file name
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._records = {}
+        self._nlines = 0
+        self._offset = 0
+        self._inode = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Read the records appended to the log file since it was last read."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            filestat = os.stat(self.filename)
+        except OSError:
+            # Removed to start again
+            self._records = {}
+            self._nlines = 0
+            self._offset = 0
+            self._inode = None
+            return
+        if filestat.st_ino != self._inode or filestat.st_size < self._offset:
+            # New or compacted log file
+            self._records = {}
+            self._nlines = 0
+            self._offset = 0
+            self._inode = filestat.st_ino
+        if filestat.st_size == self._offset:
+            return
+
+        with open(self.filename, 'rb') as fh:
+            fh.seek(self._offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    # Still being written, or partial last line of an interrupted run
+                    break
+                self._offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._records[tuple(record['targets'])] = record['depends']
+                self._nlines += 1
+
+    def get(self, targets_key):
+        """Return the recorded depend stamps for ``targets_key`` or None."""
+        return self._records.get(targets_key)
+
+    def record(self, targets_key, stamps):
+        """Record depend ``stamps`` for ``targets_key`` if they have changed."""
+        with self._lock:
+            if self._records.get(targets_key) == stamps:
+                return
+            self._records[targets_key] = stamps
+            line = json.dumps(dict(targets=targets_key, depends=stamps)) + '\n'
+            # Opened for each record so that it is never appended to a log
+            # file that has been replaced by compaction
+            with pyyaks.fileutil._file_lock(self.filename + '.lock'):
+                with open(self.filename, 'a') as fh:
+                    fh.write(line)
+
+    def close(self):
+        """Rewrite the log without superseded records if they make up most of
+        the file."""
+        if fcntl is None:
+            # Other processes might be appending
+            return
+        with self._lock:
+            if self._nlines <= 2 * len(self._records) + 100:
+                return
+            with pyyaks.fileutil._file_lock(self.filename + '.lock', exclusive=True):
+                self._refresh()
+                if self._nlines <= 2 * len(self._records) + 100:
+                    return
+                tmpname = self.filename + '.tmp'
+                with open(tmpname, 'w') as fh:
+                    for targets_key, stamps in self._records.items():
+                        fh.write(json.dumps(dict(targets=targets_key, depends=stamps)) + '\n')
+                os.replace(tmpname, self.filename)
+                filestat = os.stat(self.filename)
+                self._inode = filestat.st_ino
+                self._offset = filestat.st_size
+                self._nlines = len(self._records)
+
+# BuildLog for each build log file used in this process
+_BUILD_LOGS = {}
+
+def get_build_log(filename):
+    """Return the BuildLog for ``filename`` in this process, with the records
+    appended by other processes since it was last used.  The log file is only
+    read in full the first time.
+
+    :param filename: build log file name
+    :returns: BuildLog
+    """
+    build_log = _BUILD_LOGS.get(filename)
+    if build_log is None:
+        build_log = _BUILD_LOGS[filename] = BuildLog(filename)
+    else:
+        build_log.refresh()
+    return build_log
+
+def depend_stamps(depends):
+    """Return the build log stamps of ``depends``, which are a list of
+    ``[name, mtime_ns]`` for files and ``[name, value]`` for other ContextValues.
+
+    :param depends: list of file or value dependencies
+    :returns: list of stamps or None if any depend is missing or is a function
+    """
+    stamps = []
+    for dep in depends or ():
+        if isinstance(dep, (list, tuple)):
+            return None
+        path = _dep_path(dep)
+        if path:
+            try:
+                stamp = os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+        elif dep.mtime is None:
+            return None
+        else:
+            stamp = str(dep)
+        stamps.append([path or dep.fullname, stamp])
+    return stamps
+
+def depend_digests(fingerprints, depends):
+    """Return a dict of the content digests of ``depends`` using the
+    ``fingerprints`` cache.  Files are identified by absolute file name and
+    other ContextValues by full name.  The value of a ContextValue that is not a
+    file is hashed directly.
+
+    :param fingerprints: pyyaks.fileutil.FingerprintCache object
+    :param depends: list of file or value dependencies
+    :returns: dict of digests or None if any depend is missing or is a function
+    """
+    digests = {}
+    for dep in depends or ():
+        if isinstance(dep, (list, tuple)):
+            return None
+        path = _dep_path(dep)
+        if path:
+            digest = fingerprints.digest(path)
+        elif dep.mtime is None:
+            digest = None
+        else:
+            digest = hashlib.new(fingerprints.algorithm, str(dep).encode('utf-8')).hexdigest()
+        if digest is None:
+            return None
+        digests[path or dep.fullname] = digest
+    return digests
+
 class depends(TaskDecor):
     """Check that dependencies are met:
     - ``depends`` files or values exist
     - ``targets`` files or values exist and are all newer than every ``depends``.
 
+    If ``start()`` was called with a ``fingerprint_file`` then the task is
+    instead skipped if the targets exist and the content of the depends is the
+    same as at the last successful run of the task.  Modification times are
+    used until a run has been recorded.
+
+    If ``start()`` was called with a ``build_log`` then the task is skipped
+    straight away if the depends have the same modification times (or values)
+    as when the targets were last made or found up to date.  Only the depends
+    are checked, so remove the build log after deleting or changing targets
+    by hand.
+
     :param depends: sequence of context values that must exist on task entrance.
     :param targets: sequence of context values that must exist on task exit and be newer than
                     all ``depends`` (if supplied).
@@ -212,19 +470,70 @@ class depends(TaskDecor):
         self.depends = depends
         self.targets = targets
 
+    def __call__(self, func):
+        new_func = super(depends, self).__call__(func)
+        # Declarations used by Pipeline to order tasks
+        new_func.depends = self.depends
+        new_func.targets = self.targets
+        return new_func
+
     def setup(self):
         self.skip = False
+        build_log = status.get('build_log')
+        if build_log is not None and self.targets:
+            # Depends are unchanged since the targets were last made
+            stamps = build_log.get(_targets_key(self.targets))
+            if stamps is not None and stamps == depend_stamps(self.depends):
+                self.skip = True
+                logger.verbose('Skipping because depends unchanged in build log')
+                raise TaskSkip
+
+        fingerprints = status.get('fingerprints')
+        if fingerprints is not None and self.targets:
+            # Compare the content of the depends with the last successful run
+            # instead of modification times, if that run was recorded.
+            digests = depend_digests(fingerprints, self.depends)
+            recorded = fingerprints.recorded(_targets_key(self.targets))
+            if digests is not None and recorded is not None and _targets_exist(self.targets):
+                if digests != recorded:
+                    logger.verbose('Running because depends content changed')
+                    return
+                self.skip = True
+                self._record_run()
+                logger.verbose('Skipping because depends content unchanged')
+                raise TaskSkip
+
         depends_ok, msg = check_depend(self.depends, self.targets)
         if depends_ok and self.targets:
             self.skip = True
+            self._record_run()
             logger.verbose('Skipping because dependencies met')
             raise TaskSkip
 
     def teardown(self):
         if not self.skip and self.targets:
+            # The task may have written any of the targets
+            pyyaks.context.invalidate_stat_cache()
             depends_ok, msg = check_depend(self.depends, self.targets)
             if not depends_ok:
                 raise TaskFailure('Dependency not met after processing:\n' + msg)
+            # A task that raised an exception has set the fail status
+            if not status['fail']:
+                self._record_run()
+
+    def _record_run(self):
+        """Record the depends of the targets as up to date in the fingerprint
+        cache and build log"""
+        fingerprints = status.get('fingerprints')
+        if fingerprints is not None:
+            digests = depend_digests(fingerprints, self.depends)
+            if digests is not None:
+                fingerprints.record(_targets_key(self.targets), digests)
+        build_log = status.get('build_log')
+        if build_log is not None:
+            stamps = depend_stamps(self.depends)
+            if stamps is not None:
+                build_log.record(_targets_key(self.targets), stamps)
 
 def task(run=None):
     """Function decorator to support definition of a processing task.
@@ -244,7 +553,7 @@ def task(run=None):
 
     def decorate(func):
         def new_func(*args, **kwargs):
-            runval = run(func.__name__) if isinstance(run, collections.Callable) else run
+            runval = run(func.__name__) if callable(run) else run
             if runval is False:
                 return
             elif runval is True:
@@ -260,23 +569,107 @@ def task(run=None):
             logger.info(' Running task: %s at %s' % (func.__name__, time.ctime()))
             logger.verbose('-' * 60)
 
+            t0 = time.time()
+            usage0 = _usage()
+            result = 'ok'
             try:
                 func(*args, **kwargs)
-                pyyaks.context.store_context(status.get('context_file'))
+                deferred = _DEFERRED_STORES.get()
+                if deferred is None:
+                    _store_context()
+                else:
+                    deferred.append(func.__name__)
             except KeyboardInterrupt:
                 raise
             except TaskSkip:
-                pass
+                result = 'skip'
             except:
+                result = 'fail'
                 if status['fail'] is False:
                     logger.error('%s: %s\n\n' % (func.__name__, traceback.format_exc()))
                     status['fail'] = True
-                
-        new_func.__name__ = func.__name__
-        new_func.__doc__ = func.__doc__
+                status['failed_tasks'].append(func.__name__)
+            finally:
+                # Files written by the task make cached file status stale
+                pyyaks.context.invalidate_stat_cache()
+                usage1 = _usage()
+                status['timings'].append(TaskTiming(func.__name__, time.time() - t0,
+                                                    usage1[0] - usage0[0], usage1[1] - usage0[1],
+                                                    usage1[2] - usage0[2], result))
+
+        functools.update_wrapper(new_func, func)
         return new_func
     return decorate
 
+# Serializes the context stores of tasks run concurrently by a Pipeline
+_STORE_LOCK = threading.RLock()
+
+# List of the tasks that ran in a Pipeline worker thread, which leave storing
+# the context to the thread running the Pipeline
+_DEFERRED_STORES = contextvars.ContextVar('pyyaks_deferred_stores', default=None)
+
+def _store_context():
+    """Store the context in the context file of the task status"""
+    with _STORE_LOCK:
+        pyyaks.context.store_context(status.get('context_file'),
+                                     journal=status.get('context_journal'),
+                                     background=status.get('context_background'))
+
+TaskTiming = collections.namedtuple('TaskTiming', 'name wall user sys maxrss result')
+TaskTiming.__doc__ = """Resources used by one run of a task: task name, wall clock
+time, user and system CPU time of this process and its finished child
+processes (sec), increase of the peak resident set size of this process (MB)
+and result ('ok', 'skip' or 'fail').  CPU times and memory are for the whole
+process so they include other tasks run at the same time by a Pipeline."""
+
+def _usage():
+    """Return user and system CPU time of this process and its children and
+    the peak resident set size (MB) of this process"""
+    if resource is None:
+        times = os.times()
+        return (times.user + times.children_user, times.system + times.children_system, 0.0)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and kB elsewhere
+    maxrss = usage.ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10)
+    return (usage.ru_utime + children.ru_utime, usage.ru_stime + children.ru_stime, maxrss)
+
+def get_timings():
+    """Return the list of ``TaskTiming`` for each task run since ``start()``."""
+    return list(status['timings'])
+
+def timing_summary(timings=None, sort='wall'):
+    """Return the total resources used by each task, sorted by decreasing
+    ``sort`` value (``'wall'``, ``'user'``, ``'sys'``, ``'maxrss'`` or ``'count'``).
+
+    :param timings: list of TaskTiming (default=None => ``get_timings()``)
+    :param sort: column to sort on
+    :returns: list of (name, count, wall, user, sys, maxrss) tuples
+    """
+    idx = ('count', 'wall', 'user', 'sys', 'maxrss').index(sort)
+    totals = collections.OrderedDict()
+    for timing in (get_timings() if timings is None else timings):
+        entry = totals.get(timing.name)
+        if entry is None:
+            entry = totals[timing.name] = [0, 0.0, 0.0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += timing.wall
+        entry[2] += timing.user
+        entry[3] += timing.sys
+        entry[4] = max(entry[4], timing.maxrss)
+    rows = [(name,) + tuple(entry) for name, entry in totals.items()]
+    return sorted(rows, key=lambda x: x[idx + 1], reverse=True)
+
+def _log_timing_summary():
+    rows = timing_summary()
+    if not rows:
+        return
+    logger.info('')
+    logger.info('%-30s %6s %9s %9s %9s %9s' % ('Task', 'Count', 'Wall (s)', 'User (s)',
+                                               'Sys (s)', 'RSS (MB)'))
+    for name, count, wall, user, sys_, maxrss in rows:
+        logger.info('%-30s %6d %9.2f %9.2f %9.2f %9.1f' % (name, count, wall, user, sys_, maxrss))
+
 @task()
 def update_context(filename, keys):
     """Run pyyaks.context.update_context as a task to catch exceptions"""
@@ -288,11 +681,36 @@ def store_context(filename, keys):
     pyyaks.context.store_context(filename, keys)
 
 @pyyaks.context.render_args()
-def start(message=None, context_file=None, context_keys=None):
-    """Start a pipeline sequence."""
+def start(message=None, context_file=None, context_keys=None, context_journal=False,
+          context_background=False, fingerprint_file=None, build_log=None):
+    """Start a pipeline sequence.
+
+    If ``context_journal`` is True then the context stored after each task is
+    appended to a journal of changed values instead of rewriting
+    ``context_file``, and ``end()`` compacts the journal into ``context_file``.
+
+    If ``context_background`` is True then the context stored after each task
+    is written by a background thread, and ``end()`` waits for the writes.
+
+    If ``fingerprint_file`` is set then ``@depends`` tasks are skipped based on
+    the content of their depends (see ``depends``), using a
+    ``pyyaks.fileutil.FingerprintCache`` kept in ``fingerprint_file`` that is
+    saved by ``end()``.
+
+    If ``build_log`` is set then the depends of each task are recorded in a
+    ``BuildLog`` in file ``build_log`` (see ``get_build_log()``) and tasks with unchanged depends are
+    skipped without checking the targets (see ``depends``).
+    """
     
     status['fail'] = False
+    status['failed_tasks'] = []
+    status['timings'] = []
     status['context_file'] = context_file
+    status['context_journal'] = context_journal
+    status['context_background'] = context_background
+    status['fingerprints'] = (None if fingerprint_file is None
+                              else pyyaks.fileutil.FingerprintCache(fingerprint_file))
+    status['build_log'] = None if build_log is None else get_build_log(build_log)
     if context_file is not None and os.path.exists(context_file):
         update_context(context_file, context_keys)
 
@@ -303,11 +721,39 @@ def start(message=None, context_file=None, context_keys=None):
         logger.info('*' * 60)
 
 def end(message=None, context_file=None, context_keys=None):
-    """End a pipeline sequence."""
+    """End a pipeline sequence.  A summary of the resources used by each task
+    since ``start()`` is logged, see ``timing_summary()``."""
     
     if context_file is not None:
         store_context(context_file, context_keys)
 
+    # Compact the journal of per-task changes into a full context file
+    if status.get('context_journal') and status.get('context_file') not in (None, context_file):
+        store_context(status['context_file'], None)
+    status['context_journal'] = False
+
+    if status.get('fingerprints') is not None:
+        try:
+            status['fingerprints'].save()
+        except Exception:
+            logger.error('Fingerprint save failed: %s\n\n' % traceback.format_exc())
+            status['fail'] = True
+    status['fingerprints'] = None
+
+    if status.get('build_log') is not None:
+        status['build_log'].close()
+    status['build_log'] = None
+
+    # Wait for background context writes
+    try:
+        pyyaks.context.flush_context_writes()
+    except Exception:
+        logger.error('Context write failed: %s\n\n' % traceback.format_exc())
+        status['fail'] = True
+    status['context_background'] = False
+
+    _log_timing_summary()
+
     if message is not None:
         logger.info('')
         logger.info('*' * 60)
@@ -327,3 +773,314 @@ def make_dir(dir_):
         logger.verbose('Made directory ' + dir_)
         
 
+
+def _dep_keys(deps):
+    """Return the set of keys identifying the files or values in ``deps`` for
+    matching targets to depends in a Pipeline"""
+    keys = set()
+    for dep in deps or ():
+        if isinstance(dep, pyyaks.context.ContextValue):
+            keys.add((id(dep.parent), dep._name, dep.ext))
+        elif isinstance(dep, str):
+            keys.add(os.path.abspath(dep))
+    return keys
+
+def _context_state():
+    """Return the state of every registered ContextDict in the current context
+    as {name: (basedir, {key: (val, mtime, format)})}"""
+    return dict((name, (cdict.basedir,
+                        dict((key, (value.val, value._mtime, value._format))
+                             for key, value in dict.items(cdict._scoped()))))
+                for name, cdict in pyyaks.context._context().items())
+
+def _restore_context_state(context):
+    """Set the current context from the ``context`` state made by
+    ``_context_state()`` and return the registered ContextDicts"""
+    registered = pyyaks.context._context()
+    for name, (basedir, values) in context.items():
+        cdict = registered[name] if name in registered else pyyaks.context.ContextDict(name, basedir)
+        for key, state in values.items():
+            pyyaks.context._restore_value(cdict, key, *state)
+    return registered
+
+def _run_task_process(func, args, kwargs, context, status_items):
+    """Run ``func`` in a Pipeline worker process with the ``context`` and task
+    ``status`` of the parent process.
+
+    :returns: changed context values as {name: {key: (val, mtime, format)}}, failed tasks,
+              task timings, fingerprint cache changes (or None)
+    """
+    registered = _restore_context_state(context)
+    versions = dict(((name, key), value._version)
+                    for name, cdict in registered.items()
+                    for key, value in dict.items(cdict))
+
+    status.update(status_items)
+    # The parent process stores the context after the task
+    status['context_file'] = None
+    nfailed = len(status['failed_tasks'])
+    ntimings = len(status['timings'])
+    fingerprints = status.get('fingerprints')
+    if fingerprints is not None:
+        fingerprints_snapshot = fingerprints.snapshot()
+    func(*args, **kwargs)
+
+    changed = {}
+    for name, cdict in registered.items():
+        for key, value in dict.items(cdict):
+            if versions.get((name, key)) != value._version:
+                changed.setdefault(name, {})[key] = (value.val, value._mtime, value._format)
+    return (changed, status['failed_tasks'][nfailed:],
+            status['timings'][ntimings:],
+            None if fingerprints is None else fingerprints.changes(fingerprints_snapshot))
+
+def _run_task_thread(func, args, kwargs):
+    """Run ``func(*args, **kwargs)`` in a Pipeline worker thread and return
+    the names of the tasks that left storing the context to the Pipeline."""
+    deferred = []
+    _DEFERRED_STORES.set(deferred)
+    func(*args, **kwargs)
+    return deferred
+
+class Pipeline(object):
+    """Run a sequence of tasks, running tasks that do not depend on each other
+    concurrently.
+
+    Tasks are ordered using the ``depends`` and ``targets`` of their
+    ``@depends`` decorator: a task runs after every earlier task that has one
+    of its depends as a target (or after the later tasks that have it as a
+    target if no earlier task does), after every earlier task with one of the
+    same targets and after every earlier task that has one of its targets as a
+    depend.  Files and values are matched by ContextValue (including the
+    extension) or by file name.  A function without a ``@depends`` decorator
+    runs after all earlier tasks and before all later tasks, and so does a
+    ``@chdir`` or ``@setenv`` task when running in threads.
+
+    Tasks run in threads do not store the context when they finish.  Instead
+    the context is stored whenever no task is running and when the pipeline
+    finishes.
+
+    The usual ``@task(run=...)`` semantics apply so that, for instance, a task
+    with ``run=None`` is not run after any task has failed.  Tasks that were
+    already running when a task fails are allowed to finish.
+
+    Example::
+
+      pipe = pyyaks.task.Pipeline(max_workers=4)
+      pipe.add(make_evt2)
+      pipe.add(make_img, 'img1')
+      pipe.add(make_img, 'img2')
+      pipe.run()
+
+    With ``executor='process'`` the tasks and their arguments must be
+    picklable.  Each task is run in a worker process with a copy of the
+    current context and the context values changed by the task are copied
+    back into the context when it finishes.
+
+    :param tasks: sequence of task functions to add
+    :param executor: 'thread' or 'process' pool to run tasks
+    :param max_workers: maximum number of tasks run at once (default from concurrent.futures)
+    """
+    def __init__(self, tasks=(), executor='thread', max_workers=None):
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor = %s but must be 'thread' or 'process'" % executor)
+        self.executor = executor
+        self.max_workers = max_workers
+        self.tasks = []
+        for func in tasks:
+            self.add(func)
+
+    def add(self, func, *args, **kwargs):
+        """Add task ``func`` to be called as ``func(*args, **kwargs)``."""
+        self.tasks.append((func, args, kwargs))
+
+    def _barrier(self, func):
+        return (not hasattr(func, 'depends')
+                or (self.executor == 'thread' and getattr(func, 'serial', False)))
+
+    def graph(self):
+        """Return the list of the indices of the tasks that each task must run
+        after, in the order the tasks were added."""
+        nodes = []
+        for func, args, kwargs in self.tasks:
+            barrier = self._barrier(func)
+            reads = set() if barrier else _dep_keys(func.depends)
+            writes = set() if barrier else _dep_keys(func.targets)
+            nodes.append((barrier, reads, writes))
+
+        first_writer = {}
+        for i, (barrier, reads, writes) in enumerate(nodes):
+            for key in writes:
+                first_writer.setdefault(key, i)
+
+        preds = [[] for _ in nodes]
+        for j, (barrier_j, reads_j, writes_j) in enumerate(nodes):
+            for i, (barrier_i, reads_i, writes_i) in enumerate(nodes[:j]):
+                # A depend that no task up to i has as a target is made by a later task
+                if any(first_writer[key] > i for key in reads_i & writes_j):
+                    preds[i].append(j)
+                elif (barrier_i or barrier_j or writes_i & reads_j or writes_i & writes_j
+                      or reads_i & writes_j):
+                    preds[j].append(i)
+        return preds
+
+    def _check_cycles(self, succs, waiting, ready):
+        nrun = 0
+        while ready:
+            i = ready.pop()
+            nrun += 1
+            for j in succs[i]:
+                waiting[j] -= 1
+                if waiting[j] == 0:
+                    ready.append(j)
+        if nrun < len(self.tasks):
+            names = [self.tasks[j][0].__name__ for j, n in enumerate(waiting) if n > 0]
+            raise ValueError('Pipeline tasks have circular dependencies: %s' % ', '.join(names))
+
+    def _submit(self, pool, func, args, kwargs):
+        if self.executor == 'thread':
+            # Run in the context scope and with the task status of this thread
+            return pool.submit(contextvars.copy_context().run, _run_task_thread,
+                               func, args, kwargs)
+        # The build log is written by this process only
+        return pool.submit(_run_task_process, func, args, kwargs, _context_state(),
+                           dict(status, build_log=None))
+
+    def _finish(self, future):
+        result = future.result()
+        if self.executor == 'thread':
+            # Names of the tasks that left storing the context to this thread
+            return result
+
+        changed, failed, timings, fingerprint_changes = result
+        status['timings'].extend(timings)
+        if fingerprint_changes is not None and status.get('fingerprints') is not None:
+            status['fingerprints'].merge(fingerprint_changes)
+        registered = pyyaks.context._context()
+        for name, values in changed.items():
+            if name not in registered:
+                continue
+            for key, state in values.items():
+                pyyaks.context._restore_value(registered[name]._scoped(), key, *state)
+        if failed:
+            status['fail'] = True
+            status['failed_tasks'].extend(failed)
+        elif changed:
+            _store_context()
+        pyyaks.context.invalidate_stat_cache()
+
+    def run(self):
+        """Run all the tasks, in order of the task dependencies.  An exception
+        raised by a function that is not a task stops the pipeline after the
+        running tasks finish."""
+        preds = self.graph()
+        succs = [[] for _ in self.tasks]
+        waiting = []
+        for j, pred in enumerate(preds):
+            waiting.append(len(pred))
+            for i in pred:
+                succs[i].append(j)
+        ready = [j for j, n in enumerate(waiting) if n == 0]
+        self._check_cycles(succs, list(waiting), list(ready))
+
+        if self.executor == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(self.max_workers)
+
+        # Tasks run in threads change the context while they run, so it is
+        # stored only when no task is running
+        deferred = False
+        try:
+            with pool:
+                running = {}
+                while ready or running:
+                    for i in ready:
+                        running[self._submit(pool, *self.tasks[i])] = i
+                    ready = []
+                    done, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in sorted(done, key=running.get):
+                        i = running.pop(future)
+                        if self._finish(future):
+                            deferred = True
+                        for j in succs[i]:
+                            waiting[j] -= 1
+                            if waiting[j] == 0:
+                                ready.append(j)
+                    ready.sort()
+                    if deferred and not running:
+                        _store_context()
+                        deferred = False
+        finally:
+            if deferred:
+                _store_context()
+
+
+SourceResult = collections.namedtuple('SourceResult', 'index source success error elapsed')
+SourceResult.__doc__ = """Result of running a pipeline for one source with ``run_sources()``:
+index of the source, source, success (True or False), error message (or None)
+and wall clock time (sec)"""
+
+def _run_source(pipeline, index_source):
+    """Run ``pipeline(source)`` with a context and task status of its own."""
+    index, source = index_source
+    t0 = time.time()
+    error = None
+    with pyyaks.context.context_scope():
+        try:
+            pipeline(source)
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            error = traceback.format_exc()
+            logger.error('Source %d: %s\n\n' % (index, error))
+        else:
+            if status['failed_tasks']:
+                error = 'Failed task(s): %s' % ', '.join(status['failed_tasks'])
+    return SourceResult(index, source, error is None, error, time.time() - t0)
+
+def run_sources(pipeline, sources, processes=None, chunksize=1, maxtasksperchild=None,
+                ordered=False):
+    """Run ``pipeline(source)`` for each of ``sources`` in a pool of worker
+    processes and yield a ``SourceResult`` for each source as it finishes.
+    ::
+
+      for result in pyyaks.task.run_sources(pipeline, srcs, processes=8):
+          if not result.success:
+              print('Source', result.source, 'failed:', result.error)
+
+    Each source is run within its own ``pyyaks.context.context_scope()``, so
+    it starts from the context as it was when ``run_sources()`` was called and
+    from a new task ``status``, whatever earlier sources in the same worker did.
+    A source fails if ``pipeline`` raises an exception or any task fails.
+
+    The ``pipeline`` function and the sources must be picklable.  With
+    ``processes=0`` the sources are run one by one in this process.
+
+    :param pipeline: function that processes one source
+    :param sources: iterable of sources
+    :param processes: number of worker processes (default=None => number of CPUs)
+    :param chunksize: number of sources sent to a worker at a time
+    :param maxtasksperchild: number of chunks a worker runs before it is replaced
+                             (default=None => no limit)
+    :param ordered: yield results in the order of ``sources`` instead of as
+                    they finish
+    :returns: iterator of SourceResult
+    """
+    run_source = functools.partial(_run_source, pipeline)
+    if processes == 0:
+        for index_source in enumerate(sources):
+            yield run_source(index_source)
+        return
+
+    pool = multiprocessing.Pool(processes, _restore_context_state, (_context_state(),),
+                                maxtasksperchild)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(run_source, enumerate(sources), chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
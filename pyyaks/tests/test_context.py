@@ -2,11 +2,13 @@
 from __future__ import print_function, division, absolute_import
 
 import os
+import threading
 from pathlib import Path
 import tempfile
 import time
 from .. import logger as pyyaks_logger
 from .. import context
+from .. import fileutil
 import pytest
 
 from six.moves import cPickle as pickle
@@ -306,3 +308,857 @@ def test_reuse_context_dict_fail():
     c = context.ContextDict('c1')
     with pytest.raises(ValueError, match=r"Re-using context name 'c1' but basedirs"):
         context.ContextDict('c1', basedir='something')
+
+
+def test_template_cache():
+    """
+    Test that compiled templates are shared and the LRU bound is respected.
+    """
+    cache = context.TemplateCache(maxsize=2)
+    t1 = cache.get('{{ src.obsid }}')
+    assert cache.get('{{ src.obsid }}') is t1
+    cache.get('{{ src.ccdid }}')
+    cache.get('{{ src.ra }}')
+    assert cache.info() == dict(hits=1, misses=3, evictions=1, size=2, maxsize=2)
+    assert cache.get('{{ src.obsid }}') is not t1
+
+    src['obsid'] = 123
+    context.render('obs{{ src.obsid }}')
+    hits = context.TEMPLATE_CACHE.hits
+    assert context.render('obs{{ src.obsid }}') == 'obs123'
+    assert context.TEMPLATE_CACHE.hits == hits + 1
+
+
+def test_environment_bytecode_cache(tmpdir):
+    """
+    Test rendering through a shared environment with an on-disk bytecode cache.
+    """
+    try:
+        context.configure_environment(bytecode_cache_dir=str(tmpdir))
+        assert len(context.TEMPLATE_CACHE) == 0
+        src['obsid'] = 123
+        # A filter is needed to use jinja2 instead of the simple substitution renderer
+        assert context.render('bytecode{{ src.obsid|string }}') == 'bytecode123'
+        assert len(os.listdir(str(tmpdir))) == 1
+
+        # A fresh environment (as in a new worker) loads from the cache directory
+        context.configure_environment(bytecode_cache_dir=str(tmpdir))
+        assert context.render('bytecode{{ src.obsid|string }}') == 'bytecode123'
+        assert len(os.listdir(str(tmpdir))) == 1
+    finally:
+        context.configure_environment()
+
+
+def test_render_memo():
+    """
+    Test that rendered templates are memoized until a referenced value changes.
+    """
+    src['obsid'] = 123
+    src['ccdid'] = 2
+    src['memo_dir'] = 'obs{{ src.obsid }}'
+    files['memo_evt'] = '{{ src.memo_dir }}/ccd{{ src.ccdid }}/evt'
+    src['other'] = 1
+    assert files['memo_evt'].rel == str(Path('data/obs123/ccd2/evt'))
+    memo = files['memo_evt']._memo
+    assert memo is not None
+
+    # Unrelated change keeps the memo, nested change invalidates it
+    src['other'] = 2
+    assert files['memo_evt'].rel == str(Path('data/obs123/ccd2/evt'))
+    assert files['memo_evt']._memo is memo
+    src['obsid'] = 124
+    assert files['memo_evt'].rel == str(Path('data/obs124/ccd2/evt'))
+    src['ccdid'].clear()
+    with pytest.raises(ValueError):
+        str(files['memo_evt'])
+    src['ccdid'] = 3
+    assert files['memo_evt.fits'].rel == str(Path('data/obs124/ccd3/evt.fits'))
+
+    # Format change of a referenced value
+    src['memo_ra'] = 1.23456
+    src['memo_ra'].format = '%.2f'
+    src['memo_name'] = 'ra{{ src.memo_ra }}'
+    assert str(src['memo_name']) == 'ra1.23'
+    src['memo_ra'].format = '%.3f'
+    assert str(src['memo_name']) == 'ra1.235'
+
+    # Accessors reference the key that follows them
+    src['memo_x'] = 1
+    src['memo_val'] = 'a{{ src.val.memo_x }}'
+    assert str(src['memo_val']) == 'a1'
+    src['memo_x'] = 2
+    assert str(src['memo_val']) == 'a2'
+
+    src['memo_fmt'] = 'b{{ src.format.memo_x }}'
+    assert str(src['memo_fmt']) == 'bNone'
+    src['memo_x'].format = '%03d'
+    assert str(src['memo_fmt']) == 'b%03d'
+
+    files['memo_file'] = 'one'
+    src['memo_rel'] = '{{ files.rel.memo_file }}'
+    src['memo_abs'] = '{{ files.abs.memo_file }}'
+    assert str(src['memo_rel']) == str(Path('data/one'))
+    assert str(src['memo_abs']) == str(Path('data/one').absolute())
+    files['memo_file'] = 'two'
+    assert str(src['memo_rel']) == str(Path('data/two'))
+    assert str(src['memo_abs']) == str(Path('data/two').absolute())
+
+    # Templates that cannot be analyzed are not memoized
+    src['memo_loop'] = '{% for key in src %}{% endfor %}x'
+    assert str(src['memo_loop']) == 'x'
+    assert src['memo_loop']._memo is None
+
+
+def test_resolve_order_cycle():
+    """
+    Test dependency ordering of nested templates and detection of cycles.
+    """
+    cyc = context.ContextDict('cyc')
+    cyc['obs_dir'] = 'obs{{ src.obsid }}'
+    cyc['ccd_dir'] = '{{ cyc.obs_dir }}/ccd{{ src.ccdid }}'
+    cyc['ccd_evt'] = '{{ cyc.ccd_dir }}/acis_evt2'
+    order = context.resolve_order([cyc['ccd_evt']])
+    names = [x.fullname for x in order]
+    assert names.index('cyc.obs_dir') < names.index('cyc.ccd_dir') < names.index('cyc.ccd_evt')
+    assert names[-1] == 'cyc.ccd_evt'
+
+    cyc['a'] = 'a{{ cyc.b }}'
+    cyc['b'] = 'b{{ cyc.a }}'
+    with pytest.raises(context.ContextCycleError, match='cyc.a -> cyc.b -> cyc.a'):
+        str(cyc['a'])
+
+    cyc['self'] = '{{ cyc.self }}'
+    with pytest.raises(context.ContextCycleError):
+        str(cyc['self'])
+
+    # A template whose output is a template that never settles
+    cyc['loop'] = '{{ "{" }}{{ "{" }} cyc.loop.val {{ "}" }}{{ "}" }}'
+    with pytest.raises(context.ContextCycleError, match='did not resolve'):
+        str(cyc['loop'])
+
+
+def test_stat_cache(tmpdir):
+    """
+    Test file resolution over multiple base paths with a stat cache.
+    """
+    dir1 = tmpdir.mkdir('dir1')
+    dir2 = tmpdir.mkdir('dir2')
+    sc = context.ContextDict('stat_cache', basedir=str(dir1) + ':' + str(dir2))
+    sc['file'] = 'file'
+    cache = fileutil.StatCache()
+    prev_cache = context.set_stat_cache(cache)
+    try:
+        assert sc['file'].abs == str(dir2.join('file'))
+        assert sc['file'].mtime is None
+
+        # New file is not seen until the cache is invalidated
+        dir1.join('file').write('hello')
+        assert sc['file'].abs == str(dir2.join('file'))
+        context.invalidate_stat_cache()
+        assert sc['file'].abs == str(dir1.join('file'))
+        assert abs(sc['file'].mtime - time.time()) < 2
+
+        # Expired entries are checked again
+        cache.ttl = 0
+        dir1.join('file').remove()
+        assert sc['file'].abs == str(dir2.join('file'))
+    finally:
+        context.set_stat_cache(prev_cache)
+
+
+def test_interned_ext_views():
+    """
+    Test that extension views are reused until the base value changes.
+    """
+    files['view'] = 'view'
+    view = files['view.fits']
+    assert files['view'].fits is view
+    assert files.rel['view.fits'] == str(Path('data/view.fits'))
+
+    files['view'] = 'view2'
+    assert files['view.fits'] is not view
+    assert files['view.fits'].rel == str(Path('data/view2.fits'))
+    # Previously obtained views keep the value they were made with
+    assert view.rel == str(Path('data/view.fits'))
+
+    # A view that gets changed is not handed out again
+    view = files['view.fits']
+    view.val = 'other'
+    assert files['view.fits'] is not view
+    assert files['view.fits'].rel == str(Path('data/view2.fits'))
+
+
+def test_slots_pickle():
+    """
+    Test that the __slots__ ContextValue pickles and restores the instance
+    __dict__ state of context files written by earlier versions.
+    """
+    value = context.ContextValue(1.2345, name='slots', format='%.2f')
+    assert not hasattr(value, '__dict__')
+    value2 = pickle.loads(pickle.dumps(value))
+    assert str(value2) == '1.23'
+    assert value2.mtime == value.mtime
+
+    value3 = context.ContextValue.__new__(context.ContextValue)
+    value3.__setstate__({'_val': 2.0, '_mtime': 1.0, '_name': 'old', 'parent': None,
+                         'format': '%.1f', 'ext': None})
+    assert str(value3) == '2.0'
+    assert value3.format == '%.1f'
+    assert value3.mtime == 1.0
+
+
+def test_context_cache_copy_on_write():
+    """
+    Test that a ContextDict snapshot records only what changes and restores
+    values, formats, new keys and deleted keys.
+    """
+    CM = context.ContextDict('cow')
+    CM['a'] = 1
+    CM['b'] = 'b'
+    CM['c'] = 3.0
+    CM['c'].format = '%.1f'
+    mtime_a = CM['a'].mtime
+    a = CM['a']
+
+    with CM:
+        assert CM._context_manager_cache == [{}]
+        CM['a'] = 2
+        CM['c'].format = '%.3f'
+        CM['new'] = 'new'
+        CM['auto'].val
+        del CM['b']
+        CM.clear()
+        with CM:
+            CM['a'] = 3
+            CM['inner'] = 'inner'
+        assert CM['a'].val is None
+        assert 'inner' not in CM
+        assert len(CM._context_manager_cache[0]) == 6
+
+    assert CM._context_manager_cache == []
+    assert CM['a'] is a
+    assert CM['a'].val == 1
+    assert CM['a'].mtime == mtime_a
+    assert CM['b'].val == 'b'
+    assert str(CM['c']) == '3.0'
+    assert sorted(CM) == ['a', 'b', 'c']
+
+
+def test_context_cache_render():
+    """
+    Test that renders depending on a cached value see the restored value.
+    """
+    CM = context.ContextDict('cow_render')
+    CM['a'] = 1
+    CM['b'] = 'b{{ cow_render.a }}'
+    assert str(CM['b']) == 'b1'
+    with CM:
+        CM['a'] = 2
+        assert str(CM['b']) == 'b2'
+    assert str(CM['b']) == 'b1'
+
+
+def test_store_context_journal(tmpdir):
+    """
+    Test storing context changes in a journal and restoring base plus journal.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    jn = context.ContextDict('journal')
+    for idx in range(100):
+        jn['val%d' % idx] = idx
+    jn['ra'] = 1.23456
+    context.store_context(filename, journal=True)
+    assert not os.path.exists(filename + '.journal')
+    base_size = os.path.getsize(filename)
+
+    jn['val1'] = 'one'
+    jn['ra'].format = '%.2f'
+    context.store_context(filename, journal=True)
+    jn['new'] = 'new'
+    context.store_context(filename, journal=True)
+    assert os.path.getsize(filename + '.journal') < base_size / 4
+
+    jn.clear()
+    context.update_context(filename, keys=['journal'])
+    assert jn['val1'].val == 'one'
+    assert jn['val2'].val == 2
+    assert str(jn['ra']) == '1.23'
+    assert jn['new'].val == 'new'
+
+    # A full store removes the journal
+    context.store_context(filename)
+    assert not os.path.exists(filename + '.journal')
+    jn.clear()
+    context.update_context(filename, keys=['journal'])
+    assert jn['new'].val == 'new'
+
+
+def test_store_context_journal_stale(tmpdir):
+    """
+    Test that a journal left over from an older context file is ignored.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    jn = context.ContextDict('journal_stale')
+    jn['a'] = 1
+    context.store_context(filename, journal=True)
+    jn['a'] = 2
+    context.store_context(filename, journal=True)
+    journal = open(filename + '.journal', 'rb').read()
+
+    # Simulate a crash between writing a new full context and removing the journal
+    jn['a'] = 3
+    context.store_context(filename)
+    with open(filename + '.journal', 'wb') as fh:
+        fh.write(journal)
+    jn.clear()
+    context.update_context(filename, keys=['journal_stale'])
+    assert jn['a'].val == 3
+
+
+def test_store_context_sqlite(tmpdir):
+    """
+    Test the SQLite context store with keyed reads and incremental updates.
+    """
+    filename = str(tmpdir.join('context.db'))
+    sq = context.ContextDict('sqlite')
+    sq2 = context.ContextDict('sqlite2')
+    sq['a'] = 1
+    sq['b'] = 'b{{ sqlite.a }}'
+    sq['ra'] = 1.23456
+    sq['ra'].format = '%.3f'
+    sq2['x'] = [1, 2]
+    context.store_context(filename, keys=['sqlite', 'sqlite2'])
+
+    assert context.read_context_value(filename, 'sqlite2', 'x') == [1, 2]
+    with pytest.raises(KeyError):
+        context.read_context_value(filename, 'sqlite2', 'missing')
+
+    sq['a'] = 2
+    context.store_context(filename, keys=['sqlite', 'sqlite2'], journal=True)
+    sq.clear()
+    sq2.clear()
+    context.update_context(filename, keys=['sqlite'])
+    assert str(sq['b']) == 'b2'
+    assert str(sq['ra']) == '1.235'
+    assert sq2['x'].val is None
+
+
+def test_store_context_backend(tmpdir):
+    """
+    Test that the context file format is detected from the contents on read.
+    """
+    backend = context.ContextDict('backend')
+    backend['a'] = 1
+
+    # A pickle context file with an SQLite extension, as from older versions
+    filename = str(tmpdir.join('old.db'))
+    context.store_context(filename, keys=['backend'], backend='pickle')
+    with open(filename, 'rb') as fh:
+        assert not fh.read(16).startswith(b'SQLite')
+    backend['a'] = 2
+    # Stays a pickle file
+    context.store_context(filename, keys=['backend'])
+    backend.clear()
+    context.update_context(filename, keys=['backend'])
+    assert backend['a'].val == 2
+    assert context.read_context_value(filename, 'backend', 'a') == 2
+
+    filename = str(tmpdir.join('context.pkl'))
+    context.store_context(filename, keys=['backend'], backend='sqlite')
+    backend.clear()
+    context.update_context(filename, keys=['backend'])
+    assert backend['a'].val == 2
+    assert context.read_context_value(filename, 'backend', 'a') == 2
+
+    with pytest.raises(ValueError):
+        context.store_context(filename, keys=['backend'], backend='hdf5')
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='POSIX permissions')
+def test_store_context_umask(tmpdir):
+    """
+    Test that context files get permissions from the process umask.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    umask = context.ContextDict('umask')
+    umask['a'] = 1
+    prev_umask = os.umask(0o027)
+    try:
+        context.store_context(filename, keys=['umask'])
+    finally:
+        os.umask(prev_umask)
+    assert os.stat(filename).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmpdir)) == ['context.pkl']
+
+
+def test_store_context_background(tmpdir):
+    """
+    Test write-behind context stores, including journaled ones.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    bg = context.ContextDict('background')
+    for idx in range(10):
+        bg['a'] = idx
+        context.store_context(filename, keys=['background'], background=True)
+    bg['b'] = 'b'
+    context.store_context(filename, keys=['background'], journal=True, background=True)
+    context.flush_context_writes()
+    assert sorted(os.listdir(str(tmpdir))) == ['context.pkl', 'context.pkl.journal']
+
+    bg.clear()
+    context.update_context(filename, keys=['background'])
+    assert bg['a'].val == 9
+    assert bg['b'].val == 'b'
+
+
+def test_store_context_background_error(tmpdir):
+    """
+    Test that an error in the background writer is raised by flush_context_writes().
+    """
+    filename = str(tmpdir.join('missing', 'context.pkl'))
+    context.store_context(filename, keys=['background'], background=True)
+    with pytest.raises(OSError):
+        context.flush_context_writes()
+    context.flush_context_writes()
+
+
+def test_store_context_sidecar(tmpdir, monkeypatch):
+    """
+    Test that large values go to sidecar files that are loaded lazily.
+    """
+    monkeypatch.setattr(context, 'SIDECAR_THRESHOLD', 1000)
+    filename = str(tmpdir.join('context.pkl'))
+    sidecar = context.ContextDict('sidecar')
+    sidecar['big'] = dict((str(i), i) for i in range(1000))
+    sidecar['small'] = 'small'
+    context.store_context(filename, keys=['sidecar'])
+    assert len(os.listdir(filename + '.sidecar')) == 1
+    assert os.path.getsize(filename) < 1000
+
+    # An unchanged value keeps its sidecar file
+    sidecar_files = os.listdir(filename + '.sidecar')
+    context.store_context(filename, keys=['sidecar'])
+    assert os.listdir(filename + '.sidecar') == sidecar_files
+
+    sidecar['big'] = None
+    sidecar['small'] = None
+    # As in a new process
+    context._SIDECARS.clear()
+    context.update_context(filename, keys=['sidecar'])
+    assert type(dict.__getitem__(sidecar, 'big')._val) is context._SidecarValue
+    assert sidecar['big'].val['999'] == 999
+    assert sidecar['small'].val == 'small'
+
+    # A value loaded but not changed keeps its sidecar file
+    context.store_context(filename, keys=['sidecar'])
+    assert os.listdir(filename + '.sidecar') == sidecar_files
+
+    # Replacing the value removes the old sidecar file on the next store
+    sidecar['big'] = 1
+    context.store_context(filename, keys=['sidecar'])
+    assert os.listdir(filename + '.sidecar') == []
+
+
+def test_store_context_sidecar_background(tmpdir, monkeypatch):
+    """
+    Test that background stores write sidecar files in the writer thread and
+    remove the sidecar files that are no longer used.
+    """
+    monkeypatch.setattr(context, 'SIDECAR_THRESHOLD', 1000)
+    threads = []
+    write_sidecar = context._write_sidecar
+
+    def record_thread(*args):
+        threads.append(threading.current_thread().name)
+        write_sidecar(*args)
+    monkeypatch.setattr(context, '_write_sidecar', record_thread)
+
+    filename = str(tmpdir.join('context.pkl'))
+    sidecar_bg = context.ContextDict('sidecar_bg')
+    for i in range(5):
+        sidecar_bg['big'] = dict((str(j), i) for j in range(1000))
+        context.store_context(filename, keys=['sidecar_bg'], background=True)
+    context.flush_context_writes()
+    assert len(threads) == 5
+    assert threading.current_thread().name not in threads
+    assert len(os.listdir(filename + '.sidecar')) == 1
+
+    sidecar_bg['big'] = None
+    context.update_context(filename, keys=['sidecar_bg'])
+    assert sidecar_bg['big'].val['999'] == 4
+
+
+def test_store_context_sidecar_numpy(tmpdir, monkeypatch):
+    """
+    Test that a large numpy array sidecar value is memory mapped on load.
+    """
+    np = pytest.importorskip('numpy')
+    monkeypatch.setattr(context, 'SIDECAR_THRESHOLD', 1000)
+    filename = str(tmpdir.join('context.pkl'))
+    sidecar_np = context.ContextDict('sidecar_np')
+    sidecar_np['arr'] = np.arange(1000.0)
+    context.store_context(filename, keys=['sidecar_np'])
+    assert os.listdir(filename + '.sidecar')[0].endswith('.npy')
+
+    sidecar_files = os.listdir(filename + '.sidecar')
+
+    sidecar_np['arr'] = None
+    context._SIDECARS.clear()
+    context.update_context(filename, keys=['sidecar_np'])
+    arr = sidecar_np['arr'].val
+    assert isinstance(arr, np.memmap)
+    assert np.all(arr == np.arange(1000.0))
+
+    # Storing the loaded array again does not rewrite it, with or without a threshold
+    context.store_context(filename, keys=['sidecar_np'])
+    assert os.listdir(filename + '.sidecar') == sidecar_files
+    monkeypatch.setattr(context, 'SIDECAR_THRESHOLD', None)
+    context.store_context(filename, keys=['sidecar_np'])
+    assert os.listdir(filename + '.sidecar') == sidecar_files
+    assert os.path.getsize(filename) < 1000
+
+    # The restored array can be changed in place without changing its sidecar
+    arr[0] = -1.0
+    monkeypatch.setattr(context, 'SIDECAR_THRESHOLD', 1000)
+    context.store_context(filename, keys=['sidecar_np'])
+    sidecar_np['arr'] = None
+    context._SIDECARS.clear()
+    context.update_context(filename, keys=['sidecar_np'])
+    assert sidecar_np['arr'].val[0] == 0.0
+
+    arr = sidecar_np['arr'].val
+    arr[0] = -1.0
+    sidecar_np['arr'] = arr
+    context.store_context(filename, keys=['sidecar_np'])
+    sidecar_np['arr'] = None
+    context.update_context(filename, keys=['sidecar_np'])
+    assert sidecar_np['arr'].val[0] == -1.0
+
+
+@pytest.mark.parametrize('ext,compress,magic', [('.pkl.gz', None, b'\x1f\x8b'),
+                                                ('.pkl', 'bz2', b'BZh'),
+                                                ('.pkl.xz', None, b'\xfd7zXZ\x00')])
+def test_store_context_compress(tmpdir, ext, compress, magic):
+    """
+    Test compressed context files with the codec from the extension or parameter.
+    """
+    filename = str(tmpdir.join('context' + ext))
+    compressed = context.ContextDict('compressed')
+    compressed['words'] = ' '.join(['word'] * 1000)
+    for background in (False, True):
+        context.store_context(filename, keys=['compressed'], background=background,
+                              compress=compress)
+        context.flush_context_writes()
+        with open(filename, 'rb') as fh:
+            assert fh.read(len(magic)) == magic
+        assert os.path.getsize(filename) < 1000
+
+        compressed['words'] = None
+        context.update_context(filename, keys=['compressed'])
+        assert compressed['words'].val == ' '.join(['word'] * 1000)
+        assert context.read_context_value(filename, 'compressed', 'words').startswith('word')
+
+    with pytest.raises(ValueError):
+        context.store_context(filename, keys=['compressed'], compress='zip')
+
+
+def test_source_cursor(tmpdir):
+    """
+    Test setting ContextDict values from table rows with SourceCursor.
+    """
+    cursor_src = context.ContextDict('cursor_src')
+    cursor_src['ra'] = 1.0
+    cursor_src.format.ra = '%.2f'
+    ra = cursor_src['ra']
+
+    csv_file = str(tmpdir.join('sources.csv'))
+    with open(csv_file, 'w') as fh:
+        fh.write('id,ra,name\n10,1.5,a\n11,2.25,b\n')
+    tables = [{'id': [10, 11], 'ra': [1.5, 2.25], 'name': ['a', 'b']},
+              csv_file,
+              ([(10, 1.5, 'a'), (11, 2.25, 'b')], ('id', 'ra', 'name'))]
+    for table in tables:
+        table, names = table if isinstance(table, tuple) else (table, None)
+        cursor = context.SourceCursor(cursor_src, table, names=names)
+        assert len(cursor) == 2
+        rows = []
+        for irow in cursor:
+            cursor_src['extra'] = 'x'
+            rows.append((cursor_src['id'].val, str(cursor_src['ra']), cursor_src['name'].val))
+            assert cursor_src['ra'] is ra
+        assert rows == [(10, '1.50', 'a'), (11, '2.25', 'b')]
+
+        # Other values are cleared on each move
+        cursor.move(0)
+        assert cursor_src['extra'].val is None
+        assert cursor.row == 0
+
+    with pytest.raises(IndexError):
+        cursor.move(2)
+
+    # Moving within a ContextDict snapshot is undone at the end
+    with cursor_src:
+        cursor.move(1)
+        assert cursor_src['id'].val == 11
+    assert cursor_src['id'].val == 10
+
+
+def test_source_cursor_numpy():
+    """
+    Test SourceCursor with a NumPy structured array.
+    """
+    np = pytest.importorskip('numpy')
+    table = np.array([(10, 1.5), (11, 2.25)], dtype=[('id', 'i4'), ('ra', 'f8')])
+    cursor_np = context.ContextDict('cursor_np')
+    cursor = context.SourceCursor(cursor_np, table)
+    cursor.move(-1)
+    assert type(cursor_np['id'].val) is int
+    assert cursor_np['id'].val == 11
+    assert cursor_np['ra'].val == 2.25
+
+
+scope_src = context.ContextDict('scope_src')
+scope_files = context.ContextDict('scope_files', basedir='data')
+
+
+def test_context_scope():
+    """
+    Test that a context scope sees a private copy of the registered ContextDicts.
+    """
+    scope_src['id'] = 1
+    scope_src['name'] = 'src{{scope_src.id}}'
+    scope_files['out'] = '{{scope_src.name}}/out'
+    name = scope_src['name']
+    assert str(scope_files['out.fits']) == os.path.join('data', 'src1', 'out.fits')
+
+    with context.context_scope():
+        assert name.val == 'src{{scope_src.id}}'
+        scope_src['id'] = 2
+        scope_src.format.id = '%03d'
+        assert str(name) == 'src002'
+        assert str(scope_files['out.fits']) == os.path.join('data', 'src002', 'out.fits')
+        assert context.render('{{scope_src.name}}') == 'src002'
+
+        # A new name is only registered within the scope
+        scoped_only = context.ContextDict('scoped_only')
+        scoped_only['x'] = '{{scope_src.id}}'
+        assert str(scoped_only['x']) == '002'
+        assert context.ContextDict('scoped_only') is scoped_only
+
+        with context.context_scope():
+            assert str(name) == 'src002'
+            scope_src['id'] = 3
+            assert str(scoped_only['x']) == '003'
+        assert str(name) == 'src002'
+
+    assert 'scoped_only' not in context.CONTEXT
+    assert scope_src['id'].val == 1
+    assert scope_src.format.id is None
+    assert str(name) == 'src1'
+    assert str(scope_files['out.fits']) == os.path.join('data', 'src1', 'out.fits')
+
+
+def test_context_scope_threads(tmpdir):
+    """
+    Test running pipelines in a thread pool with a scope for each call.
+    """
+    import concurrent.futures
+    import threading
+
+    barrier = threading.Barrier(4)
+    name = scope_src['name']
+
+    @context.scoped
+    def pipeline(idx):
+        scope_src['id'] = idx
+        scope_src['name'] = 'src{{scope_src.id}}'
+        barrier.wait()
+        filename = str(tmpdir.join('context%d.pkl' % idx))
+        context.store_context(filename, keys=['scope_src'])
+        scope_src.clear()
+        context.update_context(filename, keys=['scope_src'])
+        return str(name)
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(pipeline, range(4))) == ['src0', 'src1', 'src2', 'src3']
+
+
+def test_context_scope_asyncio():
+    """
+    Test that scoped coroutines run as asyncio tasks are isolated.
+    """
+    import asyncio
+
+    @context.scoped
+    async def pipeline(idx):
+        scope_src['id'] = idx
+        await asyncio.sleep(0.01)
+        return scope_src['id'].val
+
+    async def main():
+        return await asyncio.gather(*[pipeline(idx) for idx in range(3)])
+
+    scope_src['id'] = 10
+    assert asyncio.run(main()) == [0, 1, 2]
+    assert scope_src['id'].val == 10
+
+
+def test_layered_context_dict(tmpdir):
+    """
+    Test per-source layers over default values in a LayeredContextDict.
+    """
+    layered = context.LayeredContextDict('layered')
+    layered_files = context.ContextDict('layered_files', basedir='data')
+    layered['survey'] = 'DSS'
+    layered['id'] = 0
+    layered_files['image'] = '{{layered.survey}}/{{layered.id}}/image'
+    image = layered_files['image']
+    survey = layered['survey']
+
+    for idx in (1, 2):
+        assert layered.use_layer(idx) == (None if idx == 1 else 1)
+        assert layered.val.id == 0
+        layered['id'] = idx
+        assert str(image) == os.path.join('data', 'DSS', str(idx), 'image')
+    layered.format.id = '%03d'
+    layered['survey'] = 'SDSS'
+    assert str(image) == os.path.join('data', 'SDSS', '002', 'image')
+
+    # Switching layers keeps each layer's values
+    layered.use_layer(1)
+    assert layered['survey'] is survey
+    assert str(image) == os.path.join('data', 'DSS', '1', 'image')
+    assert layered.layers == [1, 2]
+
+    # Changing a default shows in the layers that do not set it
+    layered.use_layer(None)
+    layered['survey'] = 'WISE'
+    assert str(image) == os.path.join('data', 'WISE', '0', 'image')
+    layered.use_layer(1)
+    assert str(image) == os.path.join('data', 'WISE', '1', 'image')
+    layered.use_layer(2)
+    assert str(image) == os.path.join('data', 'SDSS', '002', 'image')
+
+    # Clearing a layer shows the defaults again
+    layered.clear()
+    assert str(image) == os.path.join('data', 'WISE', '0', 'image')
+
+    # The current layer is stored as a plain ContextDict
+    layered.use_layer(1)
+    filename = str(tmpdir.join('context.pkl'))
+    context.store_context(filename, keys=['layered'])
+    with open(filename, 'rb') as fh:
+        stored = pickle.load(fh)
+    assert type(stored['layered']) is context.ContextDict
+    assert stored['layered']['id'].val == 1
+
+    layered.use_layer(3)
+    context.update_context(filename, keys=['layered'])
+    assert layered['id'].val == 1
+    assert layered['survey'].val == 'WISE'
+    layered.use_layer(2)
+    assert layered['id'].val == 0
+
+    layered.drop_layer(2)
+    assert layered.layer is None
+    assert layered.layers == [1, 3]
+
+    with context.context_scope():
+        layered.use_layer(1)
+        layered['id'] = 5
+        assert str(image) == os.path.join('data', 'WISE', '5', 'image')
+    assert layered.layer is None
+    layered.use_layer(1)
+    assert layered['id'].val == 1
+
+
+def test_fast_render():
+    """
+    Test that simple substitution templates render the same as with jinja2.
+    """
+    fast = context.ContextDict('fast')
+    fast_files = context.ContextDict('fast_files', basedir='data')
+    fast['obsid'] = 123
+    fast.format.obsid = '%05d'
+    fast['ccdid'] = 7
+    fast['name'] = 'src{{fast.ccdid}}'
+    fast['items'] = 'x'
+    fast_files['evt2'] = 'obs{{fast.obsid}}/evt2'
+
+    templates = ['obs{{fast.obsid}}/ccd{{ fast.ccdid }}/acis_evt2',
+                 '{{fast_files.evt2.fits}} {{fast_files.evt2.fits.gz}}',
+                 '{{fast.val.ccdid}} {{fast.name}} {{fast.name.rel}}',
+                 '{{fast.items}}',
+                 '{{fast.obsid.format}} {{fast_files.evt2.type}}',
+                 '{{fast.ccdid}}\n',
+                 '{{ fast.obsid|string }}',
+                 '{{ range.x }}{{fast.ccdid}}',
+                 '{% if 1 %}{{fast.ccdid}}{% endif %}']
+    cache = context.TEMPLATE_CACHE
+    for template in templates:
+        assert cache.render(template, context.CONTEXT) == \
+            cache.get(template).render(context.CONTEXT)
+
+    parts = context._fast_parts('obs{{fast.obsid}}/ccd{{ fast.ccdid }}')
+    assert parts == ('obs', ('fast', ('obsid',)), '/ccd', ('fast', ('ccdid',)), '')
+    for template in (templates[5], templates[6], templates[8]):
+        assert context._fast_parts(template) is None
+    assert cache.refs(templates[1]) == context.template_refs(templates[1])
+
+    # An undefined key raises the same error either way
+    for render in (cache.render, lambda x, y: cache.get(x).render(y)):
+        with pytest.raises(ValueError, match='fast.undefined'):
+            render('{{fast.undefined}}', context.CONTEXT)
+
+
+def test_collect_stats(tmpdir):
+    """
+    Test counting and timing of context operations.
+    """
+    stats_src = context.ContextDict('stats_src')
+    stats_files = context.ContextDict('stats_files', basedir='data:' + str(tmpdir))
+    stats_src['id'] = 1
+    stats_src['name'] = 'src{{stats_src.id}}'
+    stats_files['out'] = '{{stats_src.name}}|{{stats_src.id|string}}'
+    assert context.get_stats() is None
+
+    with context.collect_stats() as stats:
+        assert context.get_stats() is stats
+        str(stats_files['out'])
+        str(stats_files['out'])
+        stats_files['out'].mtime
+        stats_src['missing']
+        filename = str(tmpdir.join('context.pkl'))
+        context.store_context(filename, keys=['stats_src'])
+        context.update_context(filename, keys=['stats_src'])
+    assert context.get_stats() is None
+
+    snap = stats.snapshot()
+    assert snap['render']['labels']['stats_files.out']['count'] == 1
+    assert snap['render']['labels']['stats_src.name']['count'] == 1
+    assert snap['render_memo']['labels']['stats_files.out']['count'] == 2
+    assert snap['render_pass']['labels']['stats_files.out']['count'] == 1
+    assert snap['compile']['count'] == 1
+    assert snap['template_fast']['count'] == 1
+    assert snap['template_jinja']['count'] == 1
+    # Two base paths checked for each of three str() calls
+    assert snap['basedir_probe']['count'] == 6
+    assert snap['mtime_stat']['labels'] == {'stats_files.out': dict(count=1, time=0.0,
+                                                                    bytes=0)}
+    assert list(snap['autogen']['labels']) == ['stats_src.missing']
+    for event in ('store_context', 'update_context'):
+        assert snap[event]['bytes'] == os.path.getsize(filename)
+        assert snap[event]['labels'][filename]['count'] == 1
+    assert stats.top('render', n=1)[0][0] == 'stats_files.out'
+
+    stats.reset()
+    assert stats.snapshot() == {}
+
+    try:
+        stats = context.enable_stats()
+        assert context.enable_stats() is stats
+        stats_src['id'] = 2
+        str(stats_src['name'])
+        assert stats.snapshot()['render']['count'] == 1
+    finally:
+        assert context.enable_stats(False) is None
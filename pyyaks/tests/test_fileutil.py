@@ -0,0 +1,103 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import print_function, division, absolute_import
+
+import os
+import pytest
+
+from .. import fileutil
+
+CASES = [('/a/b/hello/there', '/a/b/c/d', '../../hello/there'),
+         ('/a/b/c/d/e/hello/there', '/a/b/c/d', 'e/hello/there'),
+         ('/x/y/hello/there', '/a/b/c/d', '/x/y/hello/there'),
+         ('/a/b', '/a/b/c/d', '../..'),
+         ('/a/b/c/d', '/a/b/c/d/', ''),
+         ('e/../f', '/a/b', 'f'),
+         ('../c', '/a/b', '../c'),
+         ('/a', '/', '/a'),
+         ('/', '/', ''),
+         ]
+
+
+@pytest.mark.skipif(os.sep != '/', reason='POSIX paths')
+@pytest.mark.parametrize('path, cwd, expected', CASES)
+def test_relpath(path, cwd, expected):
+    assert fileutil.relpath(path, cwd=cwd) == expected
+    # Second call comes from the memo
+    assert fileutil.relpath(path, cwd=cwd) == expected
+
+
+def test_relpath_getcwd():
+    cwd = os.getcwd()
+    assert fileutil.relpath(os.path.join(cwd, 'a', 'b')) == os.path.join('a', 'b')
+    assert fileutil.relpath(cwd) == ''
+
+
+@pytest.mark.skipif(os.sep != '/', reason='POSIX paths')
+def test_relpaths():
+    paths = [case[0] for case in CASES[:4]]
+    expected = [case[2] for case in CASES[:4]]
+    assert fileutil.relpaths(paths, cwd='/a/b/c/d') == expected
+
+
+@pytest.mark.skipif(os.sep != '/', reason='POSIX paths')
+def test_relpaths_numpy():
+    np = pytest.importorskip('numpy')
+    paths = np.array([case[0] for case in CASES[:4]]).reshape(2, 2)
+    out = fileutil.relpaths(paths, cwd='/a/b/c/d')
+    assert out.shape == (2, 2)
+    assert out.ravel().tolist() == [case[2] for case in CASES[:4]]
+
+
+def test_fingerprint_cache(tmpdir):
+    filename = str(tmpdir.join('data'))
+    with open(filename, 'w') as fh:
+        fh.write('abc')
+    cache_file = str(tmpdir.join('fingerprints.pkl'))
+    cache = fileutil.FingerprintCache(cache_file)
+    digest = cache.digest(filename)
+    assert digest == 'a9993e364706816aba3e25717850c26c9cd0d89d'
+    assert cache.digest(str(tmpdir.join('missing'))) is None
+    cache.record('task', {filename: digest})
+    cache.save()
+
+    # Same inode, size and mtime so the digest is not computed again
+    filestat = os.stat(filename)
+    with open(filename, 'w') as fh:
+        fh.write('xyz')
+    os.utime(filename, ns=(filestat.st_atime_ns, filestat.st_mtime_ns))
+    cache = fileutil.FingerprintCache(cache_file)
+    assert cache.digest(filename) == digest
+    assert cache.recorded('task') == {filename: digest}
+
+    os.utime(filename, ns=(filestat.st_atime_ns, filestat.st_mtime_ns + 1))
+    assert cache.digest(filename) != digest
+
+
+def test_fingerprint_cache_shared(tmpdir):
+    """
+    Test that caches of the same file keep the records saved by each other.
+    """
+    cache_file = str(tmpdir.join('fingerprints.pkl'))
+    cache1 = fileutil.FingerprintCache(cache_file)
+    cache2 = fileutil.FingerprintCache(cache_file)
+    cache1.record('task1', {'a': '1'})
+    cache2.record('task2', {'b': '2'})
+    cache1.save()
+    cache2.save()
+    assert cache2.recorded('task1') == {'a': '1'}
+    assert [x for x in os.listdir(str(tmpdir)) if x.endswith('.tmp')] == []
+
+    cache = fileutil.FingerprintCache(cache_file)
+    assert cache.recorded('task1') == {'a': '1'}
+    assert cache.recorded('task2') == {'b': '2'}
+
+    # A truncated cache file is treated as empty
+    with open(cache_file, 'rb') as fh:
+        data = fh.read()
+    with open(cache_file, 'wb') as fh:
+        fh.write(data[:len(data) // 2])
+    cache = fileutil.FingerprintCache(cache_file)
+    assert cache.recorded('task1') is None
+    cache.record('task3', {'c': '3'})
+    cache.save()
+    assert fileutil.FingerprintCache(cache_file).recorded('task3') == {'c': '3'}
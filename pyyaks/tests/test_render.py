@@ -9,6 +9,10 @@ SR['a'] = 'a'
 SR['b'] = 'b'
 SR['c'] = 'c'
 
+RM = context.ContextDict('rm', basedir='data')
+RM['dir'] = 'obs{{sr.a}}'
+RM['evt'] = 'obs{{sr.a}}/evt'
+
 @context.render_args()
 def func1(arg1, arg2, arg3):
     """Doc string"""
@@ -46,3 +50,15 @@ def test_render4():
 
 def test_render5():
     assert func5(val='{{sr.a}}') == '{{sr.a}}'
+
+def test_render_many():
+    vals = ['{{sr.a}}{{sr.b}}', RM['evt'], RM['evt.fits'], '{{rm.evt}}', 3]
+    expected = [context.render(x) for x in vals]
+    assert context.render_many(vals) == expected
+    assert expected[1] == os.path.join('data', 'obsa', 'evt')
+    assert expected[2] == os.path.join('data', 'obsa', 'evt.fits')
+
+def test_render_all():
+    RM['undefined'].format = '%d'
+    assert RM.render_all() == dict((key, RM[key].rel) for key in ('dir', 'evt'))
+    assert SR.render_all() == {'a': 'a', 'b': 'b', 'c': 'c'}
@@ -0,0 +1,483 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import subprocess
+import threading
+
+import pytest
+
+from .. import context
+from .. import task
+from .. import fileutil
+from .. import logger as pyyaks_logger
+
+logger = pyyaks_logger.get_logger()
+
+TSRC = context.ContextDict('tsrc')
+TPIPE = context.ContextDict('tpipe')
+TPIPE_FILE = context.ContextDict('tpipe_file', basedir='.')
+TPIPE_FILE['evt'] = 'evt'
+
+
+@task.task()
+def set_a():
+    TSRC['a'] = 1
+
+
+@task.task()
+def set_b():
+    TSRC['b'] = '{{ tsrc.a }}b'
+
+
+def test_context_journal(tmpdir):
+    """
+    Test that per-task context stores are journaled and compacted at end().
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    task.start(context_file=filename, context_journal=True)
+    set_a()
+    assert not os.path.exists(filename + '.journal')
+    set_b()
+    assert os.path.exists(filename + '.journal')
+    task.end()
+    assert not os.path.exists(filename + '.journal')
+
+    TSRC.clear()
+    task.start(context_file=filename)
+    assert str(TSRC['b']) == '1b'
+    task.end()
+
+
+def test_context_background(tmpdir):
+    """
+    Test that end() waits for per-task context stores written in the background.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    task.start(context_file=filename, context_journal=True, context_background=True)
+    set_a()
+    set_b()
+    task.end()
+    assert sorted(os.listdir(str(tmpdir))) == ['context.pkl']
+
+    TSRC.clear()
+    context.update_context(filename)
+    assert str(TSRC['b']) == '1b'
+
+
+def test_status_scope():
+    """
+    Test that the task status is separate for each context scope.
+    """
+    task.status['fail'] = True
+    with context.context_scope():
+        assert task.status['fail'] is False
+        task.status['fail'] = True
+    with context.context_scope():
+        assert task.status['fail'] is False
+    task.status['fail'] = False
+
+
+def touch(filename):
+    with open(filename, 'w'):
+        pass
+
+
+IMG_BARRIER = threading.Barrier(2, timeout=10)
+
+
+@task.task()
+@task.depends(targets=['raw'])
+def make_raw():
+    touch('raw')
+
+
+@task.task()
+@task.depends(depends=['raw'], targets=['img1'])
+def make_img1():
+    # Fails unless make_img2 is running at the same time
+    IMG_BARRIER.wait()
+    touch('img1')
+
+
+@task.task()
+@task.depends(depends=['raw'], targets=['img2'])
+def make_img2():
+    IMG_BARRIER.wait()
+    touch('img2')
+
+
+@task.task()
+@task.depends(depends=['img1', 'img2'], targets=['combined'])
+def make_combined():
+    touch('combined')
+
+
+@task.task()
+@task.depends(targets=['raw'])
+def fail_raw():
+    raise ValueError('failed')
+
+
+@task.task()
+@task.depends(targets=[TPIPE_FILE['evt.fits']])
+def make_evt():
+    pass
+
+
+@task.task()
+@task.depends(depends=[TPIPE_FILE['evt.fits']], targets=[TPIPE_FILE['evt.png']])
+def plot_evt():
+    pass
+
+
+@task.task()
+@task.depends()
+def set_pipe_value(key, val):
+    TPIPE[key] = val
+
+
+def test_pipeline_graph():
+    """
+    Test ordering of pipeline tasks by depends and targets.
+    """
+    pipe = task.Pipeline([make_raw, make_img1, make_img2, make_combined])
+    assert pipe.graph() == [[], [0], [0], [1, 2]]
+
+    # Depends are matched to targets by ContextValue and extension
+    pipe = task.Pipeline([plot_evt, make_raw, make_evt])
+    assert pipe.graph() == [[2], [], []]
+
+    # A function without depends declarations is a barrier
+    pipe = task.Pipeline([make_raw, make_img1, set_a, make_img2])
+    assert pipe.graph() == [[], [0], [0, 1], [0, 2]]
+
+    pipe = task.Pipeline([make_img1, set_a, make_raw])
+    with pytest.raises(ValueError):
+        pipe.run()
+
+
+@task.task()
+@task.depends(depends=['cat.fits'], targets=['cat.fits'])
+def update_cat():
+    with open('cat.fits', 'a') as fh:
+        fh.write('cat')
+
+
+def test_pipeline_graph_update(tmpdir, monkeypatch):
+    """
+    Test ordering of tasks that update a target in place.
+    """
+    pipe = task.Pipeline([update_cat, update_cat, update_cat])
+    assert pipe.graph() == [[], [0], [0, 1]]
+
+    # A task that changes a depend of an earlier task runs after it
+    pipe = task.Pipeline([make_raw, make_img1, make_raw])
+    assert pipe.graph() == [[], [0], [0, 1]]
+
+    monkeypatch.chdir(tmpdir)
+    touch('cat.fits')
+    task.start()
+    pipe = task.Pipeline([update_cat, update_cat], max_workers=2)
+    pipe.run()
+    assert task.status['fail'] is False
+    task.end()
+
+
+def test_pipeline_thread(tmpdir, monkeypatch):
+    """
+    Test running independent pipeline tasks concurrently in threads.
+    """
+    monkeypatch.chdir(tmpdir)
+    task.start()
+    pipe = task.Pipeline([make_combined, make_img2, make_img1, make_raw], max_workers=2)
+    pipe.run()
+    assert task.status['fail'] is False
+    task.end()
+    assert sorted(os.listdir(str(tmpdir))) == ['combined', 'img1', 'img2', 'raw']
+
+
+@task.task()
+@task.depends()
+def set_pipe_values(prefix, n):
+    for i in range(n):
+        TPIPE['%s_%d' % (prefix, i)] = i
+
+
+def test_pipeline_thread_store(tmpdir):
+    """
+    Test storing the context of tasks run concurrently in threads.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    TPIPE.clear()
+    task.start(context_file=filename)
+    pipe = task.Pipeline(max_workers=8)
+    for i in range(16):
+        pipe.add(set_pipe_values, 'v%d' % i, 200)
+    pipe.run()
+    assert task.status['fail'] is False
+    task.end()
+
+    TPIPE.clear()
+    context.update_context(filename)
+    assert len(TPIPE) == 16 * 200
+    assert TPIPE['v15_199'].val == 199
+
+
+def test_pipeline_fail(tmpdir, monkeypatch):
+    """
+    Test that tasks after a failed task are not run.
+    """
+    monkeypatch.chdir(tmpdir)
+    task.start()
+    pipe = task.Pipeline([fail_raw, make_img1, make_img2, make_combined])
+    pipe.run()
+    assert task.status['fail'] is True
+    task.end()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_pipeline_process(tmpdir):
+    """
+    Test running pipeline tasks in worker processes.
+    """
+    filename = str(tmpdir.join('context.pkl'))
+    TPIPE.clear()
+    TPIPE['c'] = 3
+    task.start(context_file=filename)
+    pipe = task.Pipeline(executor='process', max_workers=2)
+    pipe.add(set_pipe_value, 'a', 1)
+    pipe.add(set_pipe_value, 'b', '{{ tpipe.c }}b')
+    pipe.run()
+    assert task.status['fail'] is False
+    assert [x.name for x in task.get_timings()] == ['set_pipe_value', 'set_pipe_value']
+    task.end()
+    assert TPIPE['a'].val == 1
+    assert str(TPIPE['b']) == '3b'
+
+    TPIPE.clear()
+    context.update_context(filename)
+    assert str(TPIPE['b']) == '3b'
+
+
+def test_pipeline_process_fail(tmpdir, monkeypatch):
+    """
+    Test that tasks after a failed task in a worker process are not run.
+    """
+    monkeypatch.chdir(tmpdir)
+    task.start()
+    pipe = task.Pipeline([fail_raw, make_img1], executor='process')
+    pipe.run()
+    assert task.status['fail'] is True
+    assert task.status['failed_tasks'] == ['fail_raw']
+    task.end()
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.skipif(task.fcntl is None, reason='needs fcntl')
+def test_build_log_shared(tmpdir):
+    """
+    Test a build log shared by several writers, with compaction.
+    """
+    filename = str(tmpdir.join('build.log'))
+    log1 = task.BuildLog(filename)
+    log2 = task.BuildLog(filename)
+    for i in range(200):
+        log1.record(('a',), [['in_a', i]])
+    log2.record(('b',), [['in_b', 1]])
+    log1.refresh()
+    assert log1.get(('b',)) == [['in_b', 1]]
+
+    # Compaction keeps the records of other writers and they keep appending
+    log2.record(('c',), [['in_c', 1]])
+    log1.close()
+    with open(filename) as fh:
+        assert len(fh.readlines()) == 3
+    log2.record(('d',), [['in_d', 1]])
+    log3 = task.BuildLog(filename)
+    assert sorted(log3._records) == [('a',), ('b',), ('c',), ('d',)]
+    assert log3.get(('a',)) == [['in_a', 199]]
+
+    log1.refresh()
+    assert log1.get(('d',)) == [['in_d', 1]]
+    os.unlink(filename)
+    log1.refresh()
+    assert log1.get(('a',)) is None
+
+
+FINGERPRINT_RUNS = []
+
+
+@task.task()
+@task.depends(depends=['fp_in'], targets=['fp_out'])
+def fingerprint_task():
+    FINGERPRINT_RUNS.append(1)
+    touch('fp_out')
+
+
+def test_fingerprint(tmpdir, monkeypatch):
+    """
+    Test skipping tasks based on the content of depends.
+    """
+    monkeypatch.chdir(tmpdir)
+    fingerprint_file = str(tmpdir.join('fingerprints.pkl'))
+    with open('fp_in', 'w') as fh:
+        fh.write('1')
+
+    def run():
+        task.start(fingerprint_file=fingerprint_file)
+        fingerprint_task()
+        assert task.status['fail'] is False
+        task.end()
+
+    run()
+    assert len(FINGERPRINT_RUNS) == 1
+
+    # Newer depend with the same content
+    mtime = os.path.getmtime('fp_out')
+    os.utime('fp_in', (mtime + 10, mtime + 10))
+    run()
+    assert len(FINGERPRINT_RUNS) == 1
+
+    # Same size and older but different content
+    with open('fp_in', 'w') as fh:
+        fh.write('2')
+    os.utime('fp_in', (mtime - 10, mtime - 10))
+    run()
+    assert len(FINGERPRINT_RUNS) == 2
+
+
+def test_fingerprint_pipeline_process(tmpdir, monkeypatch):
+    """
+    Test that fingerprints recorded by tasks in worker processes are kept.
+    """
+    monkeypatch.chdir(tmpdir)
+    fingerprint_file = str(tmpdir.join('fingerprints.pkl'))
+    with open('fp_in', 'w') as fh:
+        fh.write('1')
+    task.start(fingerprint_file=fingerprint_file)
+    task.Pipeline([fingerprint_task], executor='process').run()
+    assert task.status['fail'] is False
+    task.end()
+
+    fingerprints = fileutil.FingerprintCache(fingerprint_file)
+    recorded = fingerprints.recorded((str(tmpdir.join('fp_out')),))
+    assert recorded == {str(tmpdir.join('fp_in')): fingerprints.digest('fp_in')}
+
+
+BUILD_LOG_RUNS = []
+
+
+@task.task()
+@task.depends(depends=['bl_in'], targets=['bl_out'])
+def build_log_task():
+    BUILD_LOG_RUNS.append(1)
+    touch('bl_out')
+
+
+def test_build_log(tmpdir, monkeypatch):
+    """
+    Test skipping tasks with depends unchanged since the last run in the build log.
+    """
+    monkeypatch.chdir(tmpdir)
+    build_log = str(tmpdir.join('build.log'))
+    touch('bl_in')
+
+    def run():
+        task.start(build_log=build_log)
+        build_log_task()
+        assert task.status['fail'] is False
+        task.end()
+
+    run()
+    assert len(BUILD_LOG_RUNS) == 1
+
+    # Skipped from the build log without checking targets
+    def no_check_depend(*args):
+        raise AssertionError('check_depend called')
+    monkeypatch.setattr(task, 'check_depend', no_check_depend)
+    run()
+    assert len(BUILD_LOG_RUNS) == 1
+    monkeypatch.undo()
+    monkeypatch.chdir(tmpdir)
+
+    mtime = os.stat('bl_out').st_mtime_ns
+    # Changed depend so targets are checked and found up to date
+    os.utime('bl_in', ns=(mtime - 10**9, mtime - 10**9))
+    run()
+    assert len(BUILD_LOG_RUNS) == 1
+    with open(build_log) as fh:
+        assert len(fh.readlines()) == 2
+
+
+@task.task()
+def set_source_values(source):
+    TPIPE['c'] = source
+    TPIPE['d'] = '{{ tpipe.c }}{{ tpipe.e }}'
+    if source == 2:
+        raise ValueError('bad source')
+
+
+def source_pipeline(source):
+    task.start()
+    assert task.status['fail'] is False
+    assert TPIPE['c'].val is None
+    set_source_values(source)
+    task.end()
+    if source == 3:
+        raise ValueError('bad pipeline')
+    return str(TPIPE['d'])
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_run_sources(processes):
+    """
+    Test running a pipeline for each source with a separate context and status.
+    """
+    TPIPE.clear()
+    TPIPE['e'] = 'e'
+    results = list(task.run_sources(source_pipeline, range(5), processes=processes,
+                                    maxtasksperchild=1))
+    assert TPIPE['c'].val is None
+    results.sort(key=lambda result: result.index)
+    assert [result.source for result in results] == list(range(5))
+    assert [result.success for result in results] == [True, True, False, False, True]
+    assert results[2].error == 'Failed task(s): set_source_values'
+    assert 'bad pipeline' in results[3].error
+    assert all(result.elapsed >= 0 for result in results)
+
+
+@task.task()
+def busy_child():
+    subprocess.check_call([sys.executable, '-c',
+                           'import time\nt0 = time.time()\nwhile time.time() - t0 < 0.3: pass'])
+
+
+@task.task()
+def fail_task():
+    raise ValueError('failed')
+
+
+def test_timings():
+    """
+    Test recording resources used by each task.
+    """
+    task.start()
+    set_a()
+    busy_child()
+    set_a()
+    fail_task()
+    timings = task.get_timings()
+    task.end()
+    assert [(x.name, x.result) for x in timings] == [('set_a', 'ok'), ('busy_child', 'ok'),
+                                                     ('set_a', 'ok'), ('fail_task', 'fail')]
+    busy = timings[1]
+    assert busy.wall >= 0.3
+    # CPU time of the finished child process is included
+    assert busy.user + busy.sys >= 0.2
+
+    rows = task.timing_summary(timings)
+    assert rows[0][:2] == ('busy_child', 1)
+    assert sorted(row[:2] for row in rows) == [('busy_child', 1), ('fail_task', 1), ('set_a', 2)]
+    assert [row[0] for row in task.timing_summary(timings, sort='count')][0] == 'set_a'